@@ -0,0 +1,78 @@
+"""
+Micro-benchmark of the rolling bands outlier detector against the list comprehension previously used in
+`main_page.page_outlier_detection`, and of the streaming detector, that appends the last points of the series one by
+one, against computing all the bands again after each of them. Their results are checked in `tests`.
+
+    python -m benchmarks.bench_rolling_bands
+"""
+import argparse
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from src.productimeseries.utilities.outlier_detection import StreamingRollingBands, get_window_size, \
+    rolling_band_outliers, rolling_bands
+
+
+def legacy_rolling_band_outliers(column: pd.Series, window_percentage: float = 5):
+    """ Bands as they were computed in `main_page.page_outlier_detection` """
+    n = len(column)
+    k = int(len(column) * (window_percentage / 100))
+    get_bands = lambda data: (np.mean(data) + 2.5 * np.std(data), np.mean(data) - 2.5 * np.std(data))
+    bands = [get_bands(column.iloc[range(0 if i - k < 0 else i - k, i + k if i + k < n else n)]) for i in
+             range(0, n)]
+    upper_detection, lower_detection = zip(*bands)
+    anomalies = (column > upper_detection) | (column < lower_detection)
+    return np.array(upper_detection), np.array(lower_detection), anomalies
+
+
+def _synthetic_series(n: int, seed: int = 0) -> pd.Series:
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2018-03-26", periods=n, freq="5D")
+    values = 0.5 + 0.2 * np.sin(np.arange(n) / 20) + rng.normal(0, 0.05, n)
+    values[rng.choice(n, size=max(1, n // 50), replace=False)] += 0.5
+    return pd.Series(values, index=dates, name="ndvi")
+
+
+def append_streaming(values: np.ndarray, k: int, appended: int):
+    """ Append the last `appended` points of a series one by one to a `StreamingRollingBands` """
+    detector = StreamingRollingBands.from_values(values[:-appended], k)
+    return lambda: [detector.update(value) for value in values[-appended:]]
+
+
+def batch_rolling_bands(values: np.ndarray, k: int, appended: int):
+    """ Bands of a series computed again after appending each of its last `appended` points """
+    for end in range(len(values) - appended + 1, len(values) + 1):
+        upper, lower = rolling_bands(values[:end], k)
+    return upper, lower, (values > upper) | (values < lower)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--appended", type=int, default=10, help="Points appended to the streaming detector")
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        series = _synthetic_series(n)
+        legacy_time = min(timeit.repeat(lambda: legacy_rolling_band_outliers(series), number=1, repeat=args.repeat))
+        vectorized_time = min(timeit.repeat(lambda: rolling_band_outliers(series), number=1, repeat=args.repeat))
+        print(f"n={n:>6}  legacy={legacy_time * 1000:9.2f} ms  vectorized={vectorized_time * 1000:7.2f} ms  "
+              f"speedup={legacy_time / vectorized_time:8.1f}x")
+
+        values = series.to_numpy()
+        k = get_window_size(n, 5)
+        appended = min(args.appended, n - 1)
+        batch_time = min(timeit.repeat(lambda: batch_rolling_bands(values, k, appended), number=1,
+                                       repeat=args.repeat))
+        # A new detector for each repetition, as the points can only be appended once
+        streaming_time = min(timeit.timeit(append_streaming(values, k, appended), number=1)
+                             for _ in range(args.repeat))
+        print(f"n={n:>6}  appending {appended} points  batch={batch_time * 1000:9.2f} ms  "
+              f"streaming={streaming_time * 1000:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Benchmarks of the ingestion and detection hot paths, run offline against synthetic fixtures (see
+`benchmarks.fixtures`). The timings are written to a JSON report, that can be compared with the report of another
+commit.
+
+    python -m benchmarks.bench_suite --output report.json
+    python -m benchmarks.bench_suite --output new.json --compare report.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from benchmarks.fixtures import GEOJSON_DIR, get_geojson_path, get_geometry, make_grid_geojson, make_index_tif, \
+    make_products, use_local_services
+from src.productimeseries.config import settings
+
+
+def _time(function, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "median": statistics.median(timings), "mean": statistics.mean(timings),
+            "repeat": repeat}
+
+
+def bench_read_raster(tmp_dirname: str, args) -> dict:
+    from src.productimeseries.utilities.raster import _read_raster
+
+    tif_path = make_index_tif(os.path.join(tmp_dirname, "read_raster.tif"), seed=0, scale=args.scale)
+    geometry = get_geometry("Teatinos")
+    return _time(lambda: _read_raster(tif_path, mask_geometry=geometry), args.repeat)
+
+
+def bench_cut_specific_tif(tmp_dirname: str, args) -> dict:
+    from src.productimeseries.utilities.utils import _cut_specific_tif
+
+    tif_path = make_index_tif(os.path.join(tmp_dirname, "cut.tif"), seed=0, scale=args.scale)
+    cut_path = os.path.join(tmp_dirname, "cut_result.tif")
+    return _time(lambda: _cut_specific_tif(get_geojson_path("Teatinos"), tif_path, cut_path), args.repeat)
+
+
+def bench_read_labeled_pixels(tmp_dirname: str, args) -> dict:
+    from src.productimeseries.utilities.raster import _read_labeled_pixels
+
+    tif_path = make_index_tif(os.path.join(tmp_dirname, "labeled_pixels.tif"), seed=0, scale=args.scale)
+    with open(tif_path, "rb") as f:
+        sample_band = f.read()
+
+    def read_labeled_pixels():
+        with rasterio.io.MemoryFile(sample_band) as memfile:
+            with memfile.open() as band_file:
+                return _read_labeled_pixels(band_file, get_geojson_path("Teatinos"))
+
+    return _time(read_labeled_pixels, args.repeat)
+
+
+def bench_feature_zonal_statistics(tmp_dirname: str, args) -> dict:
+    from src.productimeseries.reduction import reduce_raster
+    from src.productimeseries.utilities.zonal_statistics import check_zonal_statistics
+
+    tif_path = make_index_tif(os.path.join(tmp_dirname, "features.tif"), seed=0, scale=args.scale)
+    with open(tif_path, "rb") as f:
+        sample_band = f.read()
+    geojson_path = make_grid_geojson(os.path.join(tmp_dirname, "features.geojson"), args.features)
+    statistics = check_zonal_statistics(settings.ZONAL_STATISTICS)
+    return _time(lambda: reduce_raster(sample_band, {"features": geojson_path}, statistics), args.repeat)
+
+
+def bench_get_tile_from_geojson(tmp_dirname: str, args) -> dict:
+    import src.productimeseries.utilities.utils as utils
+
+    def _cold():
+        # Without the tile index, as in a new deployment
+        if os.path.exists(settings.TILE_INDEX_FILE):
+            os.remove(settings.TILE_INDEX_FILE)
+        utils._tile_index.clear()
+        utils._tile_index_loaded = False
+        utils.get_tile_from_geojson(get_geojson_path("Teatinos"))
+
+    return _time(_cold, args.repeat)
+
+
+def bench_get_tile_from_geojson_cached(tmp_dirname: str, args) -> dict:
+    from src.productimeseries.utilities.utils import get_tile_from_geojson
+
+    get_tile_from_geojson(get_geojson_path("Teatinos"))
+    return _time(lambda: get_tile_from_geojson(get_geojson_path("Teatinos")), args.repeat)
+
+
+def bench_rolling_bands(tmp_dirname: str, args) -> dict:
+    from src.productimeseries.utilities.outlier_detection import rolling_band_outliers
+
+    rng = np.random.default_rng(0)
+    series = pd.Series(rng.normal(0.5, 0.1, args.series_length),
+                       index=pd.date_range("2018-03-26", periods=args.series_length, freq="5D"))
+    return _time(lambda: rolling_band_outliers(series, 5, 2.5), args.repeat)
+
+
+def _bench_generate_time_series(tmp_dirname: str, args, in_memory: bool, mode: str = "threads") -> dict:
+    import main
+
+    mongo_client = use_local_services(os.path.join(tmp_dirname, "minio"))
+    products = make_products(os.path.join(tmp_dirname, "minio"), settings.MINIO_BUCKET_NAME_PRODUCTS, args.products,
+                             ["ndvi"], scale=args.scale)
+    timeseries_collection = mongo_client[settings.MONGO_DB][settings.MONGO_TIMESERIES_COLLECTION]
+    settings.INGESTION_IN_MEMORY = in_memory
+    settings.INGESTION_MODE = mode
+
+    def _generate():
+        timeseries_collection.delete_many({})
+        with tempfile.TemporaryDirectory() as products_dirname:
+            main.generate_time_series_from_products(get_geojson_path("Teatinos"), "Teatinos", "ndvi", products,
+                                                    timeseries_collection, products_dirname)
+        assert timeseries_collection.count_documents({}) == len(products)
+
+    return _time(_generate, args.repeat)
+
+
+def bench_generate_time_series_in_memory(tmp_dirname: str, args) -> dict:
+    return _bench_generate_time_series(tmp_dirname, args, in_memory=True)
+
+
+def bench_generate_time_series_on_disk(tmp_dirname: str, args) -> dict:
+    return _bench_generate_time_series(tmp_dirname, args, in_memory=False)
+
+
+def bench_generate_time_series_processes(tmp_dirname: str, args) -> dict:
+    return _bench_generate_time_series(tmp_dirname, args, in_memory=True, mode="processes")
+
+
+def bench_generate_time_series_async(tmp_dirname: str, args) -> dict:
+    return _bench_generate_time_series(tmp_dirname, args, in_memory=True, mode="async")
+
+
+BENCHMARKS = {
+    "read_raster_masked": bench_read_raster,
+    "cut_specific_tif": bench_cut_specific_tif,
+    "read_labeled_pixels": bench_read_labeled_pixels,
+    "feature_zonal_statistics": bench_feature_zonal_statistics,
+    "get_tile_from_geojson": bench_get_tile_from_geojson,
+    "get_tile_from_geojson_cached": bench_get_tile_from_geojson_cached,
+    "rolling_bands": bench_rolling_bands,
+    "generate_time_series_in_memory": bench_generate_time_series_in_memory,
+    "generate_time_series_on_disk": bench_generate_time_series_on_disk,
+    "generate_time_series_processes": bench_generate_time_series_processes,
+    "generate_time_series_async": bench_generate_time_series_async,
+}
+
+
+def _get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_reports(report: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compare the median timings of two reports. Returns the benchmarks slower than the baseline by more than
+    `threshold` (e.g. 0.1 is 10 %).
+    """
+    print(f"\nComparison with {baseline.get('commit')} ({baseline.get('created')}):")
+    regressions = []
+    for name, result in report["results"].items():
+        if name not in baseline["results"]:
+            print(f"  {name:<32} new")
+            continue
+        ratio = result["median"] / baseline["results"][name]["median"]
+        mark = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = "  <- slower"
+        print(f"  {name:<32} {baseline['results'][name]['median'] * 1000:10.2f} ms -> "
+              f"{result['median'] * 1000:10.2f} ms  x{ratio:5.2f}{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="benchmark_report.json", help="JSON report with the timings")
+    parser.add_argument("--compare", help="JSON report of another commit to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown over the compared report that is reported as a regression")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--products", type=int, default=20, help="Products of the end to end benchmarks")
+    parser.add_argument("--scale", type=int, default=1, help="Size of the synthetic clips, in clips of Teatinos")
+    parser.add_argument("--series-length", type=int, default=2000, help="Points of the time series of the detector")
+    parser.add_argument("--features", type=int, default=100, help="Features of the GeoJson of the zonal statistics")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dirname:
+        # Local files of the workflow, and no MinIO cache so that every read goes through the workflow
+        settings.TMP_DIR = tmp_dirname
+        settings.TILE_INDEX_FILE = os.path.join(tmp_dirname, "tile_index.json")
+        settings.DB_DIR = str(GEOJSON_DIR)
+        settings.MINIO_CACHE_DIR = None
+        for name in args.only or BENCHMARKS:
+            results[name] = BENCHMARKS[name](tmp_dirname, args)
+            print(f"{name:<32} median {results[name]['median'] * 1000:10.2f} ms  "
+                  f"min {results[name]['min'] * 1000:10.2f} ms")
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": _get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"repeat": args.repeat, "products": args.products, "scale": args.scale,
+                   "series_length": args.series_length, "features": args.features},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("params") != report["params"]:
+            print(f"Warning: the reports were run with different parameters: {baseline.get('params')}")
+        regressions = compare_reports(report, baseline, args.threshold)
+        if regressions:
+            raise SystemExit(f"Slower than {args.compare}: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
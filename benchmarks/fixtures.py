@@ -0,0 +1,177 @@
+"""
+Synthetic fixtures of the benchmarks, so that they run offline: float32 GeoTIFF clips of the index of the products
+around the bundled GeoJsons, products of the products collection, and local stand-ins of MinIO (a directory) and
+MongoDB (mongomock).
+"""
+import calendar
+import hashlib
+import io
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pyproj
+import rasterio
+from rasterio.transform import from_origin
+
+GEOJSON_DIR = Path(__file__).resolve().parent.parent / "geojson"
+# Sentinel-2 tile and CRS of the bundled GeoJsons
+TILE = "30SUF"
+CRS = "EPSG:32630"
+# Bounds (lon/lat) of the `indexes/teatinos` clips, a 10 m grid of about 160 x 45 pixels
+CLIP_BOUNDS = (-4.4835, 36.7130, -4.4660, 36.7170)
+PIXEL_SIZE = 10
+
+
+def get_geojson_path(geojson_name: str) -> str:
+    return str(GEOJSON_DIR / (geojson_name + ".geojson"))
+
+
+def get_geometry(geojson_name: str) -> dict:
+    with open(get_geojson_path(geojson_name)) as f:
+        return json.load(f)["features"][0]["geometry"]
+
+
+def make_index_tif(path: str, seed: int, scale: int = 1, nan_fraction: float = 0.05):
+    """
+    Write a float32 GeoTIFF with random index values, shaped like the clips of the products. `scale` multiplies the
+    size of the clip around its center, to measure bigger rasters.
+    """
+    transformer = pyproj.Transformer.from_crs("EPSG:4326", CRS, always_xy=True)
+    x_min, y_min = transformer.transform(*CLIP_BOUNDS[:2])
+    x_max, y_max = transformer.transform(*CLIP_BOUNDS[2:])
+    width = int((x_max - x_min) / PIXEL_SIZE) * scale
+    height = int((y_max - y_min) / PIXEL_SIZE) * scale
+    x_origin = (x_min + x_max) / 2 - width * PIXEL_SIZE / 2
+    y_origin = (y_min + y_max) / 2 + height * PIXEL_SIZE / 2
+
+    rng = np.random.default_rng(seed)
+    band = rng.uniform(-1, 1, (1, height, width)).astype(np.float32)
+    band[rng.random(band.shape) < nan_fraction] = np.nan
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with rasterio.open(path, "w", driver="GTiff", width=width, height=height, count=1, dtype="float32", crs=CRS,
+                       transform=from_origin(x_origin, y_origin, PIXEL_SIZE, PIXEL_SIZE), nodata=np.nan) as dst:
+        dst.write(band)
+    return path
+
+
+def make_grid_geojson(path: str, n: int) -> str:
+    """
+    Write a GeoJson with `n` rectangular features (parcels) in a grid covering the clips
+    """
+    columns = int(np.ceil(np.sqrt(n * 4)))
+    rows = int(np.ceil(n / columns))
+    lon_step = (CLIP_BOUNDS[2] - CLIP_BOUNDS[0]) / columns
+    lat_step = (CLIP_BOUNDS[3] - CLIP_BOUNDS[1]) / rows
+    features = []
+    for i in range(n):
+        lon = CLIP_BOUNDS[0] + (i % columns) * lon_step
+        lat = CLIP_BOUNDS[1] + (i // columns) * lat_step
+        ring = [[lon, lat], [lon + lon_step, lat], [lon + lon_step, lat + lat_step], [lon, lat + lat_step], [lon, lat]]
+        features.append({"type": "Feature", "id": f"parcel-{i}", "properties": {},
+                         "geometry": {"type": "Polygon", "coordinates": [ring]}})
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    return path
+
+
+def make_products(minio_root: str, bucket: str, n: int, indexes: list, scale: int = 1) -> list:
+    """
+    Products of the products collection, one every 5 days, with the TIF of each index stored in the local MinIO
+    """
+    products = []
+    for i in range(n):
+        date = datetime(2020, 1, 1, 11) + timedelta(days=5 * i)
+        title = f"S2A_MSIL2A_{date:%Y%m%dT%H%M%S}_N0213_R137_T{TILE}_{date:%Y%m%dT%H%M%S}"
+        products.append({
+            "id": f"product-{i}",
+            "title": title,
+            "date": date,
+            "indexes": [{"name": "cloud-mask", "value": 0.01, "mask": {"geojson": "teatinos"}}],
+        })
+        for j, index in enumerate(indexes):
+            object_name = str(Path(str(date.year), calendar.month_name[date.month], title, "indexes", "teatinos",
+                                   index + ".tif"))
+            make_index_tif(os.path.join(minio_root, bucket, object_name), seed=i * len(indexes) + j, scale=scale)
+    return products
+
+
+class _LocalObject:
+    def __init__(self, data: bytes):
+        self._data = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._data.read(amt)
+
+    def stream(self, amt=1024 * 1024):
+        while True:
+            chunk = self._data.read(amt)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class _LocalObjectStat:
+    def __init__(self, path: str):
+        self.size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            self.etag = hashlib.md5(f.read()).hexdigest()
+
+
+class LocalMinio:
+    """
+    Stand-in of `MinioConnection` that serves the objects of a local directory, with a subdirectory per bucket
+    """
+    root = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def _get_path(self, bucket_name: str, object_name: str) -> str:
+        path = os.path.join(self.root, bucket_name, object_name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return path
+
+    def fget_object(self, bucket_name: str, object_name: str, file_path: str, *args, **kwargs):
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        shutil.copyfile(self._get_path(bucket_name, object_name), file_path)
+
+    def get_object(self, bucket_name: str, object_name: str, *args, **kwargs):
+        with open(self._get_path(bucket_name, object_name), "rb") as f:
+            return _LocalObject(f.read())
+
+    def stat_object(self, bucket_name: str, object_name: str, *args, **kwargs):
+        return _LocalObjectStat(self._get_path(bucket_name, object_name))
+
+    def read_object(self, bucket_name: str, object_name: str) -> bytes:
+        with open(self._get_path(bucket_name, object_name), "rb") as f:
+            return f.read()
+
+
+def use_local_services(minio_root: str):
+    """
+    Make the workflow use `LocalMinio` and an in-memory mongomock server. Returns the mongomock client.
+    """
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("The benchmarks need mongomock as MongoDB stand-in: pip install mongomock")
+
+    import main
+    import src.productimeseries.mongo as mongo
+
+    mongo_client = mongomock.MongoClient()
+    mongo._get_mongo_client = lambda *args, **kwargs: mongo_client
+    LocalMinio.root = minio_root
+    main.MinioConnection = LocalMinio
+    return mongo_client
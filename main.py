@@ -1,15 +1,35 @@
-from src.productimeseries.utilities.utils import _download_sample_band_from_product_list, _cut_specific_tif, \
-    get_products_id_from_mongo, \
-    get_time_series_from_products_mongo, get_tile_from_geojson
+from src.productimeseries.utilities.utils import _download_sample_band_from_product_list, \
+    _read_sample_band_from_product_list, get_products_id_from_mongo, get_time_series_update, \
+    get_time_series_dataframe, get_tile_from_geojson, get_last_product_date, get_last_time_series_date, \
+    get_time_series_watermark, set_time_series_watermark, get_done_product_ids, has_ledger_entries, \
+    has_pending_failures, get_ledger_update, get_outliers_dataframe, get_outliers_updates, set_outliers_state, \
+    get_time_series_frame, get_zonal_statistics_dataframe, get_feature_time_series_dataframe
+from src.productimeseries.utilities.outlier_detection import ROLLING_BANDS_DETECTOR, ROLLING_BANDS_VERSION, \
+    StreamingRollingBands, get_window_size, rolling_bands
 from src.productimeseries.mongo import *
 from src.productimeseries.minio import *
+from src.productimeseries.ingestion_status import IngestionStatus
+from src.productimeseries.ingestion_mode import IngestionMode
+from src.productimeseries.ingestion_pipeline import run_ingestion_pipeline
+from src.productimeseries.reduction import reduce_raster, submit_reduction
+from src.productimeseries.utilities.zonal_statistics import check_zonal_statistics
+from src.productimeseries.instrumentation import count, span
+from src.productimeseries.utilities.detectors import Detector, MongoDetectorStore, get_fitted_detector
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import pandas as pd
 import numpy as np
 import os
 import calendar
+import tempfile
 from pathlib import Path
 
+# Indexes of every product stored in MinIO
+INDEXES = ['ndvi', 'tci', 'ri', 'cri1', 'bri', 'classifier', 'moisture',
+           'evi', 'osavi', 'evi2', 'ndre', 'ndyi', 'ndsi', 'ndwi', 'mndwi', 'bsi']
+
 
 def execute_workflow(geojson_name: str, start_date: str, end_date: str, index: str, tmp_dirname: str):
     """
@@ -26,112 +46,434 @@ def execute_workflow(geojson_name: str, start_date: str, end_date: str, index: s
 
     """
 
+    with span("execute_workflow", geojson=geojson_name, index=index):
+        update_time_series(geojson_name, start_date, end_date, index, tmp_dirname)
+        return read_time_series(geojson_name, start_date, end_date, index)
+
+
+def read_time_series(geojson_name: str, start_date: str, end_date: str, index: str) -> pd.DataFrame:
+    """
+    Read the time series of a GeoJson and an index stored in timeseries_collection, without updating it
+    """
+    mongo_client = MongoConnection()
+    mongo_client.set_collection(settings.MONGO_TIMESERIES_COLLECTION)
+    timeseries_collection = mongo_client.get_collection_object()
+    with span("mongo.read_time_series") as read_span:
+        dataframe = get_time_series_dataframe(timeseries_collection, geojson_name, index, start_date, end_date)
+        read_span.set("rows", len(dataframe))
+    return dataframe
+
+
+def read_time_series_frame(geojson_names: list, indexes: list, start_date: str, end_date: str) -> pd.DataFrame:
+    """
+    Read the time series of several GeoJsons and indexes as a single DataFrame (dates x (geojson, index)), ready for
+    `detect_outliers_frame`
+    """
+    mongo_client = MongoConnection()
+    mongo_client.set_collection(settings.MONGO_TIMESERIES_COLLECTION)
+    timeseries_collection = mongo_client.get_collection_object()
+    return get_time_series_frame(timeseries_collection, geojson_names, indexes, start_date, end_date)
+
+
+def read_zonal_statistics(geojson_name: str, start_date: str, end_date: str, index: str) -> pd.DataFrame:
+    """
+    Read the zonal statistics (median, std, percentiles...) of the time series of a GeoJson and an index stored in
+    timeseries_collection, a column per statistic
+    """
+    mongo_client = MongoConnection()
+    mongo_client.set_collection(settings.MONGO_TIMESERIES_COLLECTION)
+    timeseries_collection = mongo_client.get_collection_object()
+    return get_zonal_statistics_dataframe(timeseries_collection, geojson_name, index, start_date, end_date)
+
+
+def read_feature_time_series(geojson_name: str, start_date: str, end_date: str, index: str,
+                             statistic: str = "mean") -> pd.DataFrame:
+    """
+    Read the time series of a statistic of an index of every feature of a GeoJson with several features, a column per
+    feature
+    """
+    mongo_client = MongoConnection()
+    mongo_client.set_collection(settings.MONGO_TIMESERIES_COLLECTION)
+    timeseries_collection = mongo_client.get_collection_object()
+    return get_feature_time_series_dataframe(timeseries_collection, geojson_name, index, statistic, start_date,
+                                             end_date)
+
+
+def read_outliers(geojson_name: str, start_date: str, end_date: str, index: str) -> pd.DataFrame:
+    """
+    Read the outliers of the time series of a GeoJson and an index stored in outliers_collection. They are detected over
+    the whole time series, so for a range of dates they are not the outliers of the time series of that range.
+    """
+    mongo_client = MongoConnection()
+    mongo_client.set_collection(settings.MONGO_OUTLIERS_COLLECTION)
+    outliers_collection = mongo_client.get_collection_object()
+    return get_outliers_dataframe(outliers_collection, geojson_name, index, start_date, end_date)
+
+
+def get_fitted_time_series_detector(geojson_name: str, index: str, series: pd.Series, name: str,
+                                    **params) -> Detector:
+    """
+    Detector `name` fitted with the time series of a GeoJson and an index. Fitted detectors are stored in
+    detectors_collection, so each of them is only trained again when it can't be updated with the new points.
+    """
+    ensure_indexes()
+    mongo_client = MongoConnection()
+    mongo_client.set_collection(settings.MONGO_DETECTORS_COLLECTION)
+    detectors_collection = mongo_client.get_collection_object()
+    return get_fitted_detector(MongoDetectorStore(detectors_collection), geojson_name, index, series, name, **params)
+
+
+def update_time_series(geojson_name: str, start_date: str, end_date: str, index: str, tmp_dirname: str) -> bool:
+    """
+    Ingest the products of the tile of a GeoJson that are missing in the time series of an index.
+    Returns whether the time series had to be updated.
+    """
+    ensure_indexes()
     """ From GJSON get TILE """
     geojson_path = str(Path(settings.DB_DIR, geojson_name + '.geojson'))
-    tile = get_tile_from_geojson(geojson_path)
+    with span("tile_lookup"):
+        tile = get_tile_from_geojson(geojson_path)
 
     """ Compare MongoDB collections products_collection and timeseries_collection"""
-
-    """ Get products ids from MongoDB in products_collection """
     mongo_client = MongoConnection()
     products_collection = mongo_client.get_collection_object()
-    list_products = get_products_id_from_mongo(products_collection, start_date, end_date, tile)
-    last_product = list_products[0]['date']
-    # print(last_product)
-    """ Get the last time series """
     # Establish connection with timeseries_collection
     mongo_client.set_collection(settings.MONGO_TIMESERIES_COLLECTION)
     timeseries_collection = mongo_client.get_collection_object()
-    list_ts = get_time_series_from_products_mongo(timeseries_collection, geojson_name, index, start_date, end_date)
-    # Si ese GeoJson aún no existe en MongoDB nos lo descargamos
-    if len(list_ts) < 1:
-        generate_time_series_from_products(geojson_path, geojson_name, index, list_products, timeseries_collection,
-                                           tmp_dirname)
+    mongo_client.set_collection(settings.MONGO_STATE_COLLECTION)
+    state_collection = mongo_client.get_collection_object()
+    mongo_client.set_collection(settings.MONGO_LEDGER_COLLECTION)
+    ledger_collection = mongo_client.get_collection_object()
+    mongo_client.set_collection(settings.MONGO_OUTLIERS_COLLECTION)
+    outliers_collection = mongo_client.get_collection_object()
 
-    # Si ya existe lo actualizamos
+    """ Get the last product and the watermark of the time series, both are single indexed lookups """
+    with span("mongo.watermark"):
+        last_product = get_last_product_date(products_collection, tile, end_date)
+        watermark = get_time_series_watermark(state_collection, geojson_name, index)
+        if watermark is not None:
+            last_ts = watermark['last_product_date']
+        else:
+            # Time series ingested before watermarks existed
+            last_ts = get_last_time_series_date(timeseries_collection, geojson_name, index, end_date)
+
+    """ Compare datetime, and look for products that failed and can be tried again """
+    new_products = last_product is not None and (last_ts is None or last_product > last_ts)
+    if new_products or has_pending_failures(ledger_collection, geojson_name, index):
+        # Si ese GeoJson aún no existe en MongoDB nos lo descargamos, si ya existe lo actualizamos.
+        # The ledger tells which products of the range are already done, time series ingested before the ledger
+        # existed are only updated from their last date
+        if last_ts is None or has_ledger_entries(ledger_collection, geojson_name, index):
+            update_start_date = start_date
+        else:
+            update_start_date = last_ts.strftime("%Y-%m-%d")
+        with span("mongo.products_query") as products_span:
+            list_products = get_products_id_from_mongo(products_collection, update_start_date, end_date, tile)
+            products_span.set("products", len(list_products))
+        ingested_counts = generate_time_series_from_products(geojson_path, geojson_name, index, list_products,
+                                                             timeseries_collection, tmp_dirname, ledger_collection)
+        if last_product is not None:
+            set_time_series_watermark(state_collection, geojson_name, index, last_product,
+                                      ingested_counts[(geojson_name, index)])
+        update_outliers(geojson_name, index, timeseries_collection, outliers_collection, state_collection)
+        return True
+
+    """ Outliers of time series ingested before they were stored, or found by another version of the detector """
+    outliers_state = (watermark or {}).get('outliers')
+    if outliers_state is None or outliers_state['detector'] != _get_outliers_detector():
+        update_outliers(geojson_name, index, timeseries_collection, outliers_collection, state_collection)
+    return False
+
+
+def _get_outliers_detector() -> dict:
+    return {
+        'name': ROLLING_BANDS_DETECTOR,
+        'version': ROLLING_BANDS_VERSION,
+        'params': {'window_percentage': settings.OUTLIERS_WINDOW_PERCENTAGE, 'n_std': settings.OUTLIERS_N_STD},
+    }
+
+
+def update_outliers(geojson_name: str, index: str, timeseries_collection, outliers_collection,
+                    state_collection) -> int:
+    """
+    Detect the outliers of the whole time series of a GeoJson and an index with the rolling bands, in chronological
+    order, and store the bands and anomaly flags of every date in outliers_collection.
+    The band of a point only depends on the points of its window, so when new points have only been appended after
+    the last stored outliers and the size of the window is the same, the `StreamingRollingBands` stored with them
+    only updates and stores again the last bands, whose windows contain new points.
+    Returns the number of dates whose outliers have been stored.
+    """
+    with span("update_outliers"):
+        return _update_outliers(geojson_name, index, timeseries_collection, outliers_collection, state_collection)
+
+
+def _update_outliers(geojson_name: str, index: str, timeseries_collection, outliers_collection,
+                     state_collection) -> int:
+    detector = _get_outliers_detector()
+    series = get_time_series_dataframe(timeseries_collection, geojson_name, index)[index].sort_index()
+    if series.empty:
+        return 0
+    n = len(series)
+    k = get_window_size(n, detector['params']['window_percentage'])
+
+    values = series.to_numpy(dtype=np.float64)
+    watermark = get_time_series_watermark(state_collection, geojson_name, index) or {}
+    outliers_state = watermark.get('outliers') or {}
+    bands_state = outliers_state.get('bands')
+    if bands_state is not None and outliers_state['detector'] == detector and bands_state['k'] == k \
+            and (series.index <= outliers_state['last_date']).sum() == bands_state['count']:
+        # Only new points have been appended, the stored detector updates the bands they change
+        bands = StreamingRollingBands.from_dict(bands_state)
+        changed_bands = {}
+        for value in values[bands.count:]:
+            for position, upper, lower, anomaly in zip(*bands.update(value)):
+                changed_bands[position] = (upper, lower, anomaly)
+        if not changed_bands:
+            return 0
+        positions = sorted(changed_bands)
+        outliers = pd.DataFrame([changed_bands[position] for position in positions],
+                                columns=['upper', 'lower', 'anomaly'], index=series.index[positions])
     else:
-        last_ts = list_ts[0]['date']
-        """ Compare datetime """
-        if last_product > last_ts:
-            # Take a sublist of products to update the timeseries_collection
-            sublist_products = get_products_id_from_mongo(products_collection, last_ts.strftime("%Y-%m-%d"),
-                                                          end_date, tile)
-            print("We need to insert " + str(len(sublist_products)) + " products in time series collection")
-            generate_time_series_from_products(geojson_path, geojson_name, index, sublist_products,
-                                               timeseries_collection, tmp_dirname)
-
-    final_ts_list = get_time_series_from_products_mongo(timeseries_collection, geojson_name, index,
-                                                        start_date, end_date)
-    list_index = []
-    list_dates = []
-    for ts in final_ts_list:
-        list_index.append(ts[index])
-        list_dates.append(ts['date'])
-    dataframe = pd.DataFrame(list_index, columns=[index], index=list_dates)
-    return dataframe
+        upper, lower = rolling_bands(values, k, detector['params']['n_std'])
+        outliers = pd.DataFrame({'upper': upper, 'lower': lower, 'anomaly': (values > upper) | (values < lower)},
+                                index=series.index)
+        bands = StreamingRollingBands.from_values(values, k, detector['params']['n_std'])
+
+    with BulkUpserter(outliers_collection) as bulk_upserter:
+        for query, new_values in get_outliers_updates(geojson_name, index, outliers, detector):
+            bulk_upserter.upsert(query, new_values)
+    set_outliers_state(state_collection, geojson_name, index, {
+        'detector': detector,
+        'bands': bands.to_dict(),
+        'last_date': series.index[-1].to_pydatetime(),
+        'updated': datetime.utcnow(),
+    })
+    return len(outliers)
+
+
+def execute_batch_workflow(geojson_names: list, indexes: list, start_date: str, end_date: str, tmp_dirname: str):
+    """
+    Update the time series of several GeoJsons and indexes in a single sweep over the products.
+    The products of each tile are queried once and, for every product, each index TIF is downloaded once and cut
+    with all the GeoJsons of that tile, writing one document per GeoJson and date with all the indexes.
+    """
+    ensure_indexes()
+    """ From GJSON get TILE, grouping the GeoJsons that share the same tile """
+    geojson_paths_by_tile = {}
+    for geojson_name in geojson_names:
+        geojson_path = str(Path(settings.DB_DIR, geojson_name + '.geojson'))
+        tile = get_tile_from_geojson(geojson_path)
+        geojson_paths_by_tile.setdefault(tile, {})[geojson_name] = geojson_path
+
+    mongo_client = MongoConnection()
+    products_collection = mongo_client.get_collection_object()
+    mongo_client.set_collection(settings.MONGO_TIMESERIES_COLLECTION)
+    timeseries_collection = mongo_client.get_collection_object()
+    mongo_client.set_collection(settings.MONGO_STATE_COLLECTION)
+    state_collection = mongo_client.get_collection_object()
+    mongo_client.set_collection(settings.MONGO_LEDGER_COLLECTION)
+    ledger_collection = mongo_client.get_collection_object()
+    mongo_client.set_collection(settings.MONGO_OUTLIERS_COLLECTION)
+    outliers_collection = mongo_client.get_collection_object()
+    for tile, geojson_paths in geojson_paths_by_tile.items():
+        list_products = get_products_id_from_mongo(products_collection, start_date, end_date, tile)
+        print("There are " + str(len(list_products)) + " products of tile " + tile + " for " +
+              str(len(geojson_paths)) + " geojsons and " + str(len(indexes)) + " indexes")
+        ingested_counts = generate_time_series_batch_from_products(geojson_paths, indexes, list_products,
+                                                                   timeseries_collection, tmp_dirname,
+                                                                   ledger_collection)
+        if list_products:
+            for geojson_name in geojson_paths:
+                for index in indexes:
+                    set_time_series_watermark(state_collection, geojson_name, index, list_products[0]['date'],
+                                              ingested_counts[(geojson_name, index)])
+                    update_outliers(geojson_name, index, timeseries_collection, outliers_collection,
+                                    state_collection)
 
 
 def generate_time_series_from_products(geojson_path, geojson_name, index, list_products,
-                                       timeseries_collection, tmp_dirname):
+                                       timeseries_collection, tmp_dirname, ledger_collection=None) -> Counter:
     """
             From products in MiniO download TIF images and calculate the mean of the index to insert in
             Time Series Collection
     """
+    return generate_time_series_batch_from_products({geojson_name: geojson_path}, [index], list_products,
+                                                    timeseries_collection, tmp_dirname, ledger_collection)
+
+
+def generate_time_series_batch_from_products(geojson_paths: dict, indexes: list, list_products: list,
+                                             timeseries_collection, tmp_dirname: str,
+                                             ledger_collection=None) -> Counter:
+    """
+            From products in MiniO download the TIF images of several indexes, cut them with several GeoJsons
+            (a mapping GeoJson name -> GeoJson path) and calculate the mean of every index to insert in
+            Time Series Collection.
+            Products are processed by a pool of `settings.INGESTION_WORKERS` threads, so the download of a
+            product overlaps with the crop and the mean of the others. With `settings.INGESTION_MODE` "processes"
+            the crops and means run in the reduction pool instead, with at least one thread per process of the
+            pool, and with "async" the products go through the pipeline of `run_ingestion_pipeline`.
+            With an ingestion ledger, only the (product, GeoJson, index) that are not done yet are processed, and
+            the result of each of them is recorded in the ledger once its value is stored.
+            Returns the number of products ingested for every (GeoJson name, index).
+    """
     # create a tmp directory to save TIF from products
     # if not os.path.exists(settings.TMP_DIR):
     #     os.mkdir(settings.TMP_DIR)
 
-    # Download products in local directory (The user will pass by parameters the index to be downloaded)
-    minio_client = MinioConnection()
     # We need to download and process the products than are not in timeseries_collection yet
+    done_product_ids = {}
+    if ledger_collection is not None:
+        done_product_ids = get_done_product_ids(ledger_collection, list(geojson_paths), indexes,
+                                                [product['id'] for product in list_products])
+    pending_products = []
+    pending_work = []
     for product in list_products:
-        title = product['title']
-        date_product = product['date']
-        year = str(date_product.year)
-        month = date_product.month
-        day = str(date_product.day)
-        month_name = calendar.month_name[month]
+        # Mapping index -> GeoJsons that still need the product
+        work = {}
+        for index in indexes:
+            geojsons = {geojson_name: geojson_path for geojson_name, geojson_path in geojson_paths.items()
+                        if product['id'] not in done_product_ids.get((geojson_name, index), ())}
+            if geojsons:
+                work[index] = geojsons
+        if work:
+            pending_products.append(product)
+            pending_work.append(work)
+    print("We need to insert " + str(len(pending_products)) + " of " + str(len(list_products)) +
+          " products in time series collection")
+    count("products_skipped", len(list_products) - len(pending_products))
+
+    # Download products in local directory (The user will pass by parameters the index to be downloaded)
+    minio_client = MinioConnection()
+    if IngestionMode(settings.INGESTION_MODE) == IngestionMode.ASYNC:
+        return run_ingestion_pipeline(pending_products, pending_work, timeseries_collection, ledger_collection,
+                                      minio_client)
+    process_product = partial(_get_index_statistics_from_product, minio_client=minio_client, tmp_dirname=tmp_dirname,
+                              statistics=check_zonal_statistics(settings.ZONAL_STATISTICS))
+    workers = max(1, settings.INGESTION_WORKERS)
+    if IngestionMode(settings.INGESTION_MODE) == IngestionMode.PROCESSES:
+        # Each thread waits for the reduction of its product, at least one thread per process keeps them all busy
+        workers = max(workers, settings.INGESTION_PROCESSES)
+    ingested_counts = Counter()
+    # Ledger entries are written right after the values they refer to
+    ledger_upserter = None if ledger_collection is None else BulkUpserter(ledger_collection, batch_size=None)
+    with span("generate_time_series") as generate_span, \
+            ThreadPoolExecutor(max_workers=workers) as executor, \
+            BulkUpserter(timeseries_collection, on_flush=None if ledger_upserter is None else ledger_upserter.flush) \
+            as bulk_upserter:
+        generate_span.set("products", len(pending_products))
+        try:
+            results = executor.map(process_product, pending_products, pending_work)
+            for product, (date_mongo, statistics_by_geojson, features_by_geojson, outcomes) in zip(pending_products,
+                                                                                                   results):
+                for geojson_name, index_statistics in statistics_by_geojson.items():
+                    """ Insert data in this collection. Example structure:
+                            _id(mongo): value
+                            id_geojson: value
+                            date:value
+                            index_1: value (mean)
+                            index_2: value (mean)
+                            stats: {index_1: {mean: value, median: value, ...}, index_2: {...}}
+                            features: {feature_id: {index_1: {mean: value, ...}, ...}, ...} (several features)
+                    """
+
+                    """ We need to check if exists this ranges of dates. If exists update it if not, insert new one
+                        - Creates a new document if no documents match the filter.
+                        - Updates a single document that matches the filter.
+                        Upserts are buffered and written in bulk every `settings.MONGO_BULK_SIZE` operations.
+                    """
+                    bulk_upserter.upsert(*get_time_series_update(geojson_name, date_mongo, index_statistics,
+                                                                 features_by_geojson.get(geojson_name)))
+                    for index in index_statistics:
+                        ingested_counts[(geojson_name, index)] += 1
+
+                count("products_processed")
+                for status, _ in outcomes.values():
+                    count("ingestion_results", status=status.value)
+                if ledger_upserter is not None:
+                    for (geojson_name, index), (status, reason) in outcomes.items():
+                        ledger_upserter.upsert(*get_ledger_update(product['id'], geojson_name, index, status, reason))
+        except BaseException:
+            # Products not started yet are cancelled, so that a failure doesn't wait for the whole ingestion
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return ingested_counts
+
+
+def _get_index_statistics_from_product(product: dict, work: dict, minio_client: MinioConnection, tmp_dirname: str,
+                                       statistics: list):
+    """
+        Download the TIF of each index of a product only once, cut it with every GeoJson that needs it and calculate
+        the zonal `statistics` in a single pass (see `reduce_raster`). `work` is a mapping
+        index -> {GeoJson name: GeoJson path}.
+        With `settings.INGESTION_IN_MEMORY` the TIF is read and cut in memory, without touching `tmp_dirname`.
+        Returns the date of the product, a mapping GeoJson name -> {index: {statistic: value}}, the same statistics for
+        each feature of the GeoJsons with several features (GeoJson name -> {index: {feature id: {statistic: value}}})
+        and the result of every (GeoJson name, index) as a tuple (IngestionStatus, reason). Indexes that only contain nan values or that fail
+        are left out of the statistics, so that a failing product or index never stops the processing of the others.
+    """
+    title = product['title']
+    date_product = product['date']
+    year = str(date_product.year)
+    month = date_product.month
+    day = str(date_product.day)
+    month_name = calendar.month_name[month]
+    date_mongo = datetime.strptime(year + '-' + str(month) + '-' + day, '%Y-%m-%d')
+
+    statistics_by_geojson = {}
+    features_by_geojson = {}
+    outcomes = {}
+    for index, geojson_paths in work.items():
+        sample_band_path = str(Path(tmp_dirname, title + '_' + index + '.tif'))
+        sample_band = None
         try:
-            # Download TIF in local
-            sample_band_path = str(Path(tmp_dirname, title + '_' + index + '.tif'))
-            _download_sample_band_from_product_list(sample_band_path, title, year, month_name, index, minio_client)
-            # We read and cut out the bands for each of the products.
-            sample_band_cut_path = str(
-                Path(tmp_dirname, title + '_' + geojson_name + '_' + index + '.tif'))
-            raster_result = _cut_specific_tif(geojson_path, sample_band_path, sample_band_cut_path)
-            if np.isnan(raster_result).all():
-                print("This product only contains nan values for this index")
-            else:
-                # Calculate the mean of the index for each product
-                raster_result_mean = np.nanmean(raster_result)
-
-                date_mongo = datetime.strptime(year + '-' + str(month) + '-' + day, '%Y-%m-%d')
-
-                """ Insert data in this collection. Example structure:
-                        _id(mongo): value
-                        id_geojson: value
-                        date:value
-                        index: value
-                """
-
-                """ We need to check if exists this ranges of dates. If exists update it if not, insert new one
-                    - Creates a new document if no documents match the filter.
-                    - Updates a single document that matches the filter.
-                """
-                query = {'id_geojson': geojson_name, 'date': date_mongo}
-                new_values = {"$set": {index: float(raster_result_mean)}}
-                timeseries_collection.update_one(query, new_values, upsert=True)
-
-                """
-                Finally we need to remove this Tail from local
-                """
-                if os.path.exists(sample_band_path):
-                    os.remove(sample_band_path)
-                if os.path.exists(sample_band_cut_path):
-                    os.remove(sample_band_cut_path)
+            with span("minio.download") as download_span:
+                if settings.INGESTION_IN_MEMORY:
+                    # Read TIF in memory
+                    sample_band = _read_sample_band_from_product_list(title, year, month_name, index, minio_client)
+                    downloaded_bytes = len(sample_band)
+                else:
+                    # Download TIF in local
+                    _download_sample_band_from_product_list(sample_band_path, title, year, month_name, index,
+                                                            minio_client)
+                    downloaded_bytes = os.path.getsize(sample_band_path)
+                download_span.set("bytes", downloaded_bytes)
+            count("bytes_downloaded", downloaded_bytes)
         except Exception as err:
             print(f"Unexpected {err=}, {type(err)=}")
             print("Something went wrong in the Download")
+            for geojson_name in geojson_paths:
+                outcomes[(geojson_name, index)] = (IngestionStatus.FAILED, f"Download: {err!r}")
+            continue
+
+        # Only the TIF goes to the reduction, and only the statistics come back
+        raster = sample_band if sample_band is not None else sample_band_path
+        try:
+            with span("raster.reduce"):
+                if IngestionMode(settings.INGESTION_MODE) == IngestionMode.PROCESSES:
+                    results = submit_reduction(raster, geojson_paths, statistics).result()
+                else:
+                    results = reduce_raster(raster, geojson_paths, statistics)
+        except Exception as err:
+            # The reduction pool is broken, e.g. a process has been killed
+            print(f"Unexpected {err=}, {type(err)=}")
+            print("Something went wrong cutting " + title)
+            results = {geojson_name: (IngestionStatus.FAILED.value, None, f"Cut: {err!r}", 0, None)
+                       for geojson_name in geojson_paths}
+        for geojson_name, (status, statistics_values, reason, pixels, feature_statistics) in results.items():
+            count("pixels_read", pixels)
+            if statistics_values is not None:
+                statistics_by_geojson.setdefault(geojson_name, {})[index] = statistics_values
+            if feature_statistics:
+                features_by_geojson.setdefault(geojson_name, {})[index] = feature_statistics
+            outcomes[(geojson_name, index)] = (IngestionStatus(status), reason)
+
+        """
+        Finally we need to remove this Tail from local
+        """
+        if os.path.exists(sample_band_path):
+            os.remove(sample_band_path)
+
+    return date_mongo, statistics_by_geojson, features_by_geojson, outcomes
 
 
 # def delete_documents_mongo(id_geojson):
@@ -146,12 +488,9 @@ if __name__ == '__main__':
     # delete_documents_mongo("Campo de futbol")
 
     geojson_files = ['Campo de futbol', 'Jardin Botanico', 'Bulevar']  # , path_geojson+'/Campo de futbol.geojson'
-    indexes = ['ndvi', 'tci', 'ri', 'cri1', 'bri', 'classifier', 'moisture',
-               'evi', 'osavi', 'evi2', 'ndre', 'ndyi', 'bri', 'ndsi', 'ndwi', 'mndwi', 'bsi']
 
-    for g in geojson_files:
-        for i in indexes:
-            execute_workflow(g, "2018-03-26", "2029-02-19", i)
+    with tempfile.TemporaryDirectory() as tmp_dirname:
+        execute_batch_workflow(geojson_files, INDEXES, "2018-03-26", "2029-02-19", tmp_dirname)
     # df.sort_index(inplace=True)
     # print(df)
     # df.to_csv("/home/sandro/PycharmProjects/ndvi.csv")
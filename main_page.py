@@ -6,21 +6,23 @@ import streamlit as st
 from matplotlib import cm
 from streamlit_folium import folium_static
 import shutil
-from main import execute_workflow
+from main import execute_workflow, read_time_series, read_outliers, get_fitted_time_series_detector
+from src.productimeseries.config import settings
+from src.productimeseries.instrumentation import start_metrics_server
 import os
 from src.productimeseries.utilities.raster_conversion import _get_corners_raster, open_band, normalize_band, \
     read_rgb_image
 from src.productimeseries.utilities.utils import download_specific_tif_from_minio
+from src.productimeseries.utilities.detectors import get_detector
 from src.productimeseries.utilities.streamlit_download_button import download_button
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import IsolationForest
 import tempfile
 
 st.set_page_config(
     layout="wide"
 )
+start_metrics_server()
 st.sidebar.title('Alerts Form')
 st.title('Generate Alerts in Time Series indexes from GeoJson')
 
@@ -45,6 +47,18 @@ def _execute_complete_workflow(geojson_name: str, start_date: str,
     return df_wk
 
 
+@st.cache_data(ttl=settings.WORKER_INTERVAL)
+def _read_precomputed_time_series(geojson_name: str, start_date: str, end_date: str,
+                                  index_name: str) -> pd.DataFrame:
+    # Time series are updated by the background worker, so they are read again after each poll of the worker
+    return read_time_series(geojson_name, start_date, end_date, index_name)
+
+
+@st.cache_data(ttl=settings.WORKER_INTERVAL)
+def _read_precomputed_outliers(geojson_name: str, start_date: str, end_date: str, index_name: str) -> pd.DataFrame:
+    return read_outliers(geojson_name, start_date, end_date, index_name)
+
+
 # Function to generate a Map Visualization
 def generate_map(center_location=None) -> folium.Map:
     if center_location is None:
@@ -91,16 +105,11 @@ def generate_map(center_location=None) -> folium.Map:
 
 
 def isolation_forest_outliers(df: pd.DataFrame):
-    outliers_fraction = float(.01)
-    scaler = StandardScaler()
-    np_scaled = scaler.fit_transform(df.values.reshape(-1, 1))
-    data = pd.DataFrame(np_scaled)
-    # train isolation forest
-    model = IsolationForest(contamination=outliers_fraction, n_estimators=200)  #
-    model.fit(data)
-    # plot outliers
+    # The isolation forest of each time series is trained once and stored, later sessions reuse it
     index = st.session_state['index']
-    df['anomaly'] = model.predict(data)
+    detector = get_fitted_time_series_detector(st.session_state['geojson'], index, df[index], 'isolation_forest',
+                                               contamination=.01, n_estimators=200)
+    df['anomaly'] = np.where(detector.score(df[index])['anomaly'], -1, 1)
     # visualization
     figure, ax = plt.subplots(figsize=(28, 10))
     plt.xticks(fontsize=24)
@@ -206,26 +215,43 @@ def page_outlier_detection():
             print('created temporary directory', tmp_dirname)
 
         # execute workflow
-        dataframe = _execute_complete_workflow(st.session_state["geojson"],
-                                               st.session_state["start_date"],
-                                               st.session_state["end_date"],
-                                               st.session_state["index"],
-                                               tmp_dirname)
+        if settings.BACKGROUND_INGESTION:
+            dataframe = _read_precomputed_time_series(st.session_state["geojson"],
+                                                      st.session_state["start_date"],
+                                                      st.session_state["end_date"],
+                                                      st.session_state["index"])
+            if dataframe.empty:
+                st.info("The time series of " + st.session_state['geojson'] + " for the index " +
+                        st.session_state['index'] + " has not been ingested yet, please try again later",
+                        icon="ℹ️")
+                return
+        else:
+            dataframe = _execute_complete_workflow(st.session_state["geojson"],
+                                                   st.session_state["start_date"],
+                                                   st.session_state["end_date"],
+                                                   st.session_state["index"],
+                                                   tmp_dirname)
         tempfile.TemporaryDirectory().cleanup()
         # First Detect Outliers OUTLIER DETECTION
         column = dataframe[st.session_state['index']]
-        n = len(column)
         outlier_date = dataframe.index
-        window_percentage = 5
-        k = int(len(column) * (window_percentage / 100))
-        get_bands = lambda data: (np.mean(data) + 2.5 * np.std(data), np.mean(data) - 2.5 * np.std(data))
-        # get_bands = lambda data: (np.mean(data) + np.nanquantile(data, 0.98), np.mean(data) - np.nanquantile(data, 0.98))
-        bands = [get_bands(column[range(0 if i - k < 0 else i - k, i + k if i + k < n else n)]) for i in
-                 range(0, n)]
-        upper_detection, lower_detection = zip(*bands)
+        # Outliers are detected over the whole time series when it is ingested and shown for the dates of the page.
+        # If they are not stored yet they are computed here over the whole time series too, so that the outliers
+        # never depend on whether they were stored
+        bands = _read_precomputed_outliers(st.session_state["geojson"],
+                                           st.session_state["start_date"],
+                                           st.session_state["end_date"],
+                                           st.session_state["index"])
+        if not bands.index.equals(dataframe.index):
+            series = _read_precomputed_time_series(st.session_state["geojson"], None, None,
+                                                   st.session_state["index"])[st.session_state['index']]
+            if not column.index.isin(series.index).all():
+                series = column
+            bands = get_detector('rolling_bands', window_percentage=settings.OUTLIERS_WINDOW_PERCENTAGE,
+                                 n_std=settings.OUTLIERS_N_STD).score(series).reindex(column.index)
+        upper_detection, lower_detection = bands['upper'], bands['lower']
         # compute local outliers
-        anomalies = (column > upper_detection) | (
-                column < lower_detection)
+        anomalies = bands['anomaly']
 
         # If outlier exist download last TIF outlier if not, download the last TIF os the time series
         col1, col2 = st.columns(2)
@@ -1,6 +1,7 @@
 from pathlib import Path
+from typing import Optional
 
-from pydantic import BaseSettings
+from pydantic import BaseSettings, validator
 
 
 class _Settings(BaseSettings):
@@ -12,6 +13,22 @@ class _Settings(BaseSettings):
     MONGO_DB: str = "test"
     MONGO_PRODUCTS_COLLECTION: str = "test"
     MONGO_TIMESERIES_COLLECTION: str = 'test'
+    # Ingestion state (last ingested product) of every time series
+    MONGO_STATE_COLLECTION: str = 'timeseries_state'
+    # Result (ingested, empty or failed) of every product for every time series
+    MONGO_LEDGER_COLLECTION: str = 'ingestion_ledger'
+    # Locks of the background ingestion workers, one per time series
+    MONGO_LOCK_COLLECTION: str = 'ingestion_locks'
+    # Outliers (bands and anomaly flags) of every time series
+    MONGO_OUTLIERS_COLLECTION: str = 'outliers'
+    # Fitted outlier detectors of every time series
+    MONGO_DETECTORS_COLLECTION: str = 'detectors'
+    # Number of upserts sent together in each bulk write
+    MONGO_BULK_SIZE: int = 500
+    # Connection pool shared by all the MongoDB connections of the process
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_CONNECT_TIMEOUT_MS: int = 20000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 30000
 
     # Minio-related settings
     MINIO_HOST: str = "0.0.0.0"
@@ -20,11 +37,78 @@ class _Settings(BaseSettings):
     MINIO_SECRET_KEY: str = "pass"
     MINIO_BUCKET_NAME_PRODUCTS: str = 'test'
     MINIO_BUCKET_NAME_COMPOSITES: str = None
+    # Region of the buckets, if it is set MinIO is not asked for the location of each bucket
+    MINIO_REGION: str = None
+    # Connection pool shared by all the MinIO connections of the process, it should fit the parallel downloads
+    MINIO_MAX_POOL_SIZE: int = 16
+    MINIO_TIMEOUT: int = 300
+    # Local cache of the downloaded objects, shared between sessions and processes (None disables it)
+    MINIO_CACHE_DIR: Optional[str] = "./tmp/minio_cache"
+    MINIO_CACHE_MAX_BYTES: int = 2 * 1024 ** 3
+    # Seconds the ETag of a cached object is trusted before asking MinIO for it again
+    MINIO_CACHE_ETAG_TTL: int = 300
+    # Also cache the objects read in memory (INGESTION_IN_MEMORY), writing every product ingested to disk
+    MINIO_CACHE_IN_MEMORY: bool = False
 
     # Temporal directory
     TMP_DIR: str = "./tmp"
     # Directory containing validated datasets (.kmz or .geojson)
     DB_DIR: str = "./geojson"
+    # File where the Sentinel tile of each GeoJson is stored
+    TILE_INDEX_FILE: str = "./tmp/tile_index.json"
+
+    # Ingestion-related settings
+    # Number of products downloaded and cropped at the same time (1 processes them one by one)
+    INGESTION_WORKERS: int = 4
+    # Read and cut the products in memory instead of downloading them to the temporal directory
+    INGESTION_IN_MEMORY: bool = True
+    # Number of projected GeoJsons and pixel masks kept in memory
+    MASK_CACHE_SIZE: int = 256
+    # Times a failed product is tried again before giving up
+    INGESTION_MAX_ATTEMPTS: int = 3
+    # How products are processed: "threads" (a pool of INGESTION_WORKERS threads), "processes" (the threads download
+    # the products and a pool of INGESTION_PROCESSES processes crops them) or "async" (a pipeline of downloads, crops
+    # in the pool of processes and bulk writes, connected by bounded queues)
+    INGESTION_MODE: str = "threads"
+    # Processes cropping the products in the "processes" and "async" modes
+    INGESTION_PROCESSES: int = 4
+    # Zonal statistics of the pixels of every GeoJson stored with each product, in `stats.<index>` (the mean is also
+    # stored as the value of the index): mean, median, std, min, max, count, valid_fraction or percentiles p<N>
+    ZONAL_STATISTICS: list = ["mean", "median", "std", "min", "max", "p10", "p90", "valid_fraction"]
+    # Concurrent downloads and products waiting between two stages of the pipeline
+    PIPELINE_DOWNLOAD_CONCURRENCY: int = 8
+    PIPELINE_QUEUE_SIZE: int = 16
+    # The time series are ingested by `worker.py` and the web only reads them
+    BACKGROUND_INGESTION: bool = False
+    # First date of the time series ingested by the worker
+    INGESTION_START_DATE: str = "2018-03-26"
+    # Seconds between two polls of the worker for new products
+    WORKER_INTERVAL: int = 3600
+    # Seconds a worker holds the lock of a time series, it should be longer than the ingestion of one time series
+    WORKER_LOCK_TTL: int = 3600
+
+    # Outlier detection settings
+    # Points on each side of the window of the rolling bands, as a percentage of the points of the time series
+    OUTLIERS_WINDOW_PERCENTAGE: float = 5
+    # Width of the rolling bands in standard deviations
+    OUTLIERS_N_STD: float = 2.5
+    # Directory of the fitted outlier detectors stored on disk
+    DETECTORS_DIR: str = "./tmp/detectors"
+
+    # Instrumentation settings
+    # Time the stages of the workflow and count bytes, pixels and products (off, it has almost no overhead)
+    INSTRUMENTATION_ENABLED: bool = False
+    # File where the stages are logged as JSON lines (None prints them)
+    INSTRUMENTATION_LOG_FILE: str = None
+    # Port of the Prometheus endpoint /metrics (None doesn't serve it)
+    METRICS_PORT: int = None
+
+    @validator("MINIO_REGION", "MINIO_CACHE_DIR", "INSTRUMENTATION_LOG_FILE", "METRICS_PORT", pre=True)
+    def _empty_to_none(cls, value):
+        # `.env` values are strings, so an empty value or "None" (as in `.env-template`) means the setting is not set
+        if isinstance(value, str) and value.strip() in ("", "None"):
+            return None
+        return value
 
     class Config:
         env_file = ".env"
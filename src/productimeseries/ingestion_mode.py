@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class IngestionMode(Enum):
+    THREADS = "threads"
+    PROCESSES = "processes"
+    ASYNC = "async"
@@ -0,0 +1,188 @@
+import asyncio
+import calendar
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from src.productimeseries.config import settings
+from src.productimeseries.ingestion_status import IngestionStatus
+from src.productimeseries.instrumentation import count, span
+from src.productimeseries.minio import MinioConnection
+from src.productimeseries.mongo import BulkUpserter
+from src.productimeseries.reduction import submit_reduction
+from src.productimeseries.utilities.utils import _read_sample_band_from_product_list, get_ledger_update, \
+    get_time_series_update
+from src.productimeseries.utilities.zonal_statistics import check_zonal_statistics
+
+# Marks the end of the items of a queue
+_END = None
+
+
+def run_ingestion_pipeline(products: list, work: list, timeseries_collection, ledger_collection=None,
+                           minio_client: MinioConnection = None) -> Counter:
+    """
+    Asynchronous variant of `generate_time_series_batch_from_products`, for the products that still need to be
+    processed (`work` has, for each product, a mapping index -> {GeoJson name: GeoJson path}).
+    Each TIF goes through three stages connected by bounded queues, so that downloads never wait for the crops or the
+    other way round, and a slow stage stops the previous one instead of piling rasters up in memory:
+        1. download: `settings.PIPELINE_DOWNLOAD_CONCURRENCY` downloads from MinIO at the same time.
+        2. reduce: crop and zonal statistics in the reduction pool of `settings.INGESTION_PROCESSES` processes, that
+           only send back the statistics (see `reduce_raster`).
+        3. write: the statistics of each product are written in bulk once all its indexes are done, followed by their
+           ledger entries.
+    Returns the number of products ingested for every (GeoJson name, index).
+    """
+    return asyncio.run(_run_ingestion_pipeline(products, work, timeseries_collection, ledger_collection,
+                                               minio_client or MinioConnection()))
+
+
+async def _run_ingestion_pipeline(products: list, work: list, timeseries_collection, ledger_collection,
+                                  minio_client: MinioConnection) -> Counter:
+    statistics = check_zonal_statistics(settings.ZONAL_STATISTICS)
+    download_queue = asyncio.Queue()
+    reduce_queue = asyncio.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    write_queue = asyncio.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    for product, product_work in zip(products, work):
+        for index, geojson_paths in product_work.items():
+            download_queue.put_nowait((product, index, geojson_paths))
+
+    download_concurrency = max(1, settings.PIPELINE_DOWNLOAD_CONCURRENCY)
+    # One reducer per process keeps all the processes of the reduction pool busy
+    reduce_processes = max(1, settings.INGESTION_PROCESSES)
+    with span("generate_time_series") as generate_span, \
+            ThreadPoolExecutor(max_workers=download_concurrency) as download_executor:
+        generate_span.set("products", len(products))
+        writer = asyncio.create_task(_write(write_queue, products, work, timeseries_collection, ledger_collection))
+        downloaders = [asyncio.create_task(_download(download_queue, reduce_queue, write_queue, download_executor,
+                                                     minio_client))
+                       for _ in range(download_concurrency)]
+        reducers = [asyncio.create_task(_reduce(reduce_queue, write_queue, statistics))
+                    for _ in range(reduce_processes)]
+
+        tasks = downloaders + reducers + [writer]
+
+        # Each stage ends once the previous one has ended and its queue is empty
+        for _ in downloaders:
+            download_queue.put_nowait(_END)
+        await _wait_watching(asyncio.gather(*downloaders), tasks)
+        for _ in reducers:
+            await _wait_watching(reduce_queue.put(_END), tasks)
+        await _wait_watching(asyncio.gather(*reducers), tasks)
+        await _wait_watching(write_queue.put(_END), tasks)
+        return await _wait_watching(writer, tasks)
+
+
+async def _wait_watching(awaitable, tasks: list):
+    """
+    Wait for `awaitable` while watching the tasks of the pipeline. If any of them fails (e.g. a bulk write), all of
+    them are cancelled and its exception is raised, instead of leaving the other stages blocked on a full queue.
+    """
+    waiter = asyncio.ensure_future(awaitable)
+    while True:
+        await asyncio.wait([waiter] + [task for task in tasks if not task.done()],
+                           return_when=asyncio.FIRST_COMPLETED)
+        failed_task = next((task for task in tasks
+                            if task.done() and not task.cancelled() and task.exception() is not None), None)
+        if failed_task is not None:
+            for task in [waiter] + tasks:
+                task.cancel()
+            await asyncio.gather(waiter, *tasks, return_exceptions=True)
+            raise failed_task.exception()
+        if waiter.done():
+            return waiter.result()
+
+
+async def _download(download_queue: asyncio.Queue, reduce_queue: asyncio.Queue, write_queue: asyncio.Queue,
+                    executor: ThreadPoolExecutor, minio_client: MinioConnection):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await download_queue.get()
+        if item is _END:
+            return
+        product, index, geojson_paths = item
+        date_product = product['date']
+        try:
+            with span("minio.download") as download_span:
+                # The MinIO client is blocking, it runs in a thread of the executor
+                sample_band = await loop.run_in_executor(
+                    executor, _read_sample_band_from_product_list, product['title'], str(date_product.year),
+                    calendar.month_name[date_product.month], index, minio_client)
+                download_span.set("bytes", len(sample_band))
+            count("bytes_downloaded", len(sample_band))
+        except Exception as err:
+            print(f"Unexpected {err=}, {type(err)=}")
+            print("Something went wrong in the Download")
+            results = {geojson_name: (IngestionStatus.FAILED.value, None, f"Download: {err!r}", 0, None)
+                       for geojson_name in geojson_paths}
+            await write_queue.put((product, index, results))
+            continue
+        await reduce_queue.put((product, index, geojson_paths, sample_band))
+
+
+async def _reduce(reduce_queue: asyncio.Queue, write_queue: asyncio.Queue, statistics: list):
+    while True:
+        item = await reduce_queue.get()
+        if item is _END:
+            return
+        product, index, geojson_paths, sample_band = item
+        try:
+            with span("raster.reduce"):
+                results = await asyncio.wrap_future(submit_reduction(sample_band, geojson_paths, statistics))
+        except Exception as err:
+            # The reduction pool is broken, e.g. a process has been killed
+            print(f"Unexpected {err=}, {type(err)=}")
+            results = {geojson_name: (IngestionStatus.FAILED.value, None, f"Cut: {err!r}", 0, None)
+                       for geojson_name in geojson_paths}
+        await write_queue.put((product, index, results))
+
+
+async def _write(write_queue: asyncio.Queue, products: list, work: list, timeseries_collection,
+                 ledger_collection) -> Counter:
+    """
+    Collect the results of the indexes of each product and write them in bulk. MongoDB is blocking, so bulk writes
+    run in a thread while the pipeline goes on.
+    """
+    loop = asyncio.get_running_loop()
+    pending_indexes = {product['id']: len(product_work) for product, product_work in zip(products, work)}
+    product_results = {}
+    ingested_counts = Counter()
+    ledger_upserter = None if ledger_collection is None else BulkUpserter(ledger_collection, batch_size=None)
+    bulk_upserter = BulkUpserter(timeseries_collection, batch_size=None,
+                                 on_flush=None if ledger_upserter is None else ledger_upserter.flush)
+    while True:
+        item = await write_queue.get()
+        if item is _END:
+            break
+        product, index, results = item
+        product_results.setdefault(product['id'], {})[index] = results
+        pending_indexes[product['id']] -= 1
+        if pending_indexes[product['id']] > 0:
+            continue
+
+        """ All the indexes of the product are done, one document per GeoJson and date with all of them """
+        date_product = product['date']
+        date_mongo = datetime(date_product.year, date_product.month, date_product.day)
+        statistics_by_geojson = {}
+        features_by_geojson = {}
+        for product_index, index_results in product_results.pop(product['id']).items():
+            for geojson_name, (status, statistics_values, reason, pixels, feature_statistics) in index_results.items():
+                if statistics_values is not None:
+                    statistics_by_geojson.setdefault(geojson_name, {})[product_index] = statistics_values
+                    ingested_counts[(geojson_name, product_index)] += 1
+                if feature_statistics:
+                    features_by_geojson.setdefault(geojson_name, {})[product_index] = feature_statistics
+                count("pixels_read", pixels)
+                count("ingestion_results", status=status)
+                if ledger_upserter is not None:
+                    ledger_upserter.upsert(*get_ledger_update(product['id'], geojson_name, product_index,
+                                                              IngestionStatus(status), reason))
+        for geojson_name, index_statistics in statistics_by_geojson.items():
+            bulk_upserter.upsert(*get_time_series_update(geojson_name, date_mongo, index_statistics,
+                                                         features_by_geojson.get(geojson_name)))
+        count("products_processed")
+        if len(bulk_upserter.operations) >= settings.MONGO_BULK_SIZE:
+            await loop.run_in_executor(None, bulk_upserter.flush)
+
+    # The ledger is flushed with the time series, even if there are no values to write
+    await loop.run_in_executor(None, bulk_upserter.flush)
+    return ingested_counts
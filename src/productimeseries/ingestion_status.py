@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class IngestionStatus(Enum):
+    INGESTED = "ingested"
+    EMPTY = "empty"
+    FAILED = "failed"
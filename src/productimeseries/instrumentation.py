@@ -0,0 +1,190 @@
+import json
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from src.productimeseries.config import settings
+
+# Upper bounds, in seconds, of the buckets of the histograms of the stages
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+METRICS_PREFIX = "productimeseries"
+
+_counters = {}
+_histograms = {}
+_metrics_lock = Lock()
+_log_lock = Lock()
+_metrics_server = None
+
+
+class _Span:
+    """
+    Timer of a stage of the workflow. Attributes (e.g. bytes downloaded) can be attached while it runs, they are
+    written with its duration in the structured log.
+    """
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+        self.attributes = {}
+        self.start = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        observe("stage_seconds", duration, stage=self.name, **self.labels)
+        log_event("span", span=self.name, duration=duration, error=None if exc_type is None else repr(exc_value),
+                  **self.labels, **self.attributes)
+        return False
+
+
+class _NoopSpan:
+    """
+    Span used while instrumentation is disabled, it does nothing
+    """
+
+    def set(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **labels):
+    """
+    Time a stage of the workflow:
+
+        with span("minio.download", index=index) as download_span:
+            ...
+            download_span.set("bytes", len(data))
+
+    With `settings.INSTRUMENTATION_ENABLED` off, a shared span that does nothing is returned.
+    """
+    if not settings.INSTRUMENTATION_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, labels)
+
+
+def count(name: str, value: float = 1, **labels):
+    """
+    Increase the counter `name` (e.g. bytes downloaded, products processed) by `value`
+    """
+    if not settings.INSTRUMENTATION_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    """
+    Add an observation (e.g. the duration of a stage) to the histogram `name`
+    """
+    if not settings.INSTRUMENTATION_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(HISTOGRAM_BUCKETS), "sum": 0.0, "count": 0}
+        for i, upper_bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= upper_bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def log_event(event: str, **fields):
+    """
+    Write an event as a JSON line to `settings.INSTRUMENTATION_LOG_FILE`, or print it if there is no file
+    """
+    if not settings.INSTRUMENTATION_ENABLED:
+        return
+    line = json.dumps({"time": datetime.utcnow().isoformat(), "event": event, **fields}, default=str)
+    if settings.INSTRUMENTATION_LOG_FILE:
+        with _log_lock, open(settings.INSTRUMENTATION_LOG_FILE, "a") as f:
+            f.write(line + "\n")
+    else:
+        print(line)
+
+
+def get_metrics_text() -> str:
+    """
+    Counters and histograms in the Prometheus text exposition format
+    """
+    with _metrics_lock:
+        counters = dict(_counters)
+        histograms = {key: {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+                      for key, value in _histograms.items()}
+
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name}_total counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"{METRICS_PREFIX}_{name}_total{_format_labels(labels)} {value}")
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} histogram")
+        for (histogram_name, labels), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            for upper_bound, bucket_count in zip(HISTOGRAM_BUCKETS, histogram["buckets"]):
+                bound = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+                lines.append(f"{METRICS_PREFIX}_{name}_bucket{_format_labels(labels + (('le', bound),))} "
+                             f"{bucket_count}")
+            lines.append(f"{METRICS_PREFIX}_{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{METRICS_PREFIX}_{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped_labels = (key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                      for key, value in labels)
+    return "{" + ",".join(escaped_labels) + "}"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server():
+    """
+    Serve the metrics in http://localhost:`settings.METRICS_PORT`/metrics, if instrumentation is enabled and the port
+    is set. The server only starts once per process.
+    """
+    global _metrics_server
+    if not settings.INSTRUMENTATION_ENABLED or not settings.METRICS_PORT or _metrics_server is not None:
+        return
+    try:
+        _metrics_server = ThreadingHTTPServer(("", settings.METRICS_PORT), _MetricsHandler)
+    except OSError as err:
+        print(f"Metrics server can't listen on port {settings.METRICS_PORT}: {err}")
+        return
+    Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://localhost:{settings.METRICS_PORT}/metrics")
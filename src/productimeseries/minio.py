@@ -1,9 +1,53 @@
+from threading import Lock
+
+import urllib3
 from minio import Minio
 from src.productimeseries.config import settings
+from src.productimeseries.minio_cache import RasterCache
+
+# HTTP connection pool shared by all the MinIO connections of the process
+_http_client = None
+_http_client_lock = Lock()
+
+
+def _get_http_client() -> urllib3.PoolManager:
+    """
+    Get the HTTP connection pool used by MinIO, creating it the first time it is needed.
+    It is configured as the MinIO default one, but sized with `settings.MINIO_MAX_POOL_SIZE` for parallel downloads.
+    """
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = urllib3.PoolManager(
+                timeout=urllib3.Timeout(connect=settings.MINIO_TIMEOUT, read=settings.MINIO_TIMEOUT),
+                maxsize=settings.MINIO_MAX_POOL_SIZE,
+                retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+            )
+    return _http_client
+
+
+# Local cache of the downloaded objects, shared by all the MinIO connections of the process
+_raster_cache = None
+_raster_cache_lock = Lock()
+
+
+def get_raster_cache() -> RasterCache:
+    """
+    Get the local cache of MinIO objects, creating it the first time it is needed.
+    Returns None if the cache is disabled (`settings.MINIO_CACHE_DIR` is not set).
+    """
+    global _raster_cache
+    if not settings.MINIO_CACHE_DIR:
+        return None
+    with _raster_cache_lock:
+        if _raster_cache is None:
+            _raster_cache = RasterCache(settings.MINIO_CACHE_DIR, settings.MINIO_CACHE_MAX_BYTES,
+                                        settings.MINIO_CACHE_ETAG_TTL)
+    return _raster_cache
 
 
 class MinioConnection(Minio):
-    "A class including handled MinIO methods"
+    "A class including handled MinIO methods. All the connections share the same HTTP connection pool"
 
     def __init__(self, host=settings.MINIO_HOST, port=settings.MINIO_PORT, access_key=settings.MINIO_ACCESS_KEY,
                  secret_key=settings.MINIO_SECRET_KEY):
@@ -11,13 +55,31 @@ class MinioConnection(Minio):
             endpoint=f"{host}:{port}",
             access_key=access_key,
             secret_key=secret_key,
-            secure=False
+            secure=False,
+            region=settings.MINIO_REGION,
+            http_client=_get_http_client()
         )
 
     # @retry(n_retries=1, delay=10)
     def fget_object(self, *args, **kwargs):
-        "Handled version of the fget_object Minio's method"
-        super().fget_object(*args, **kwargs)
+        "Handled version of the fget_object Minio's method, objects are copied from the local cache when possible"
+        raster_cache = get_raster_cache()
+        if raster_cache is not None and len(args) == 3 and not kwargs:
+            raster_cache.fget_object(self, *args)
+        else:
+            super().fget_object(*args, **kwargs)
+
+    def read_object(self, bucket_name: str, object_name: str) -> bytes:
+        "Read an object in memory, from the local cache only with `settings.MINIO_CACHE_IN_MEMORY`"
+        raster_cache = get_raster_cache() if settings.MINIO_CACHE_IN_MEMORY else None
+        if raster_cache is not None:
+            return raster_cache.read_object(self, bucket_name, object_name)
+        response = self.get_object(bucket_name, object_name)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
 
     # @retry(n_retries=100, delay=60)
     def fput_object(self, *args, **kwargs):
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+from minio import Minio
+
+
+class RasterCache:
+    """
+    On-disk LRU cache of MinIO objects, keyed by bucket, object name and ETag.
+    Entries are written to a temporary file and renamed, so concurrent readers from other threads or processes never
+    see a partial file. When the cache grows over `max_bytes`, the least recently used entries are removed.
+    The entries and their sizes are tracked in memory, and the ETag of an object is only asked to MinIO again after
+    `etag_ttl` seconds, so a hit doesn't touch the network. Other processes write entries too, so the entries are
+    scanned from disk again before evicting and after every `max_bytes / 16` downloaded by this process: the entries
+    on disk are never over `max_bytes` by more than that for each process sharing the cache.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, etag_ttl: float = 0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.etag_ttl = etag_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evicted_bytes = 0
+        self._lock = Lock()
+        # Entry path -> size, from the least to the most recently used
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        # Bytes downloaded by this process since the entries were scanned from disk
+        self._scan_bytes = 0
+        # (bucket, object name) -> (ETag, time it was asked to MinIO)
+        self._etags = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan_entries()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evicted_bytes": self.evicted_bytes}
+
+    def fget_object(self, minio_client: Minio, bucket_name: str, object_name: str, file_path: str):
+        """
+        Copy an object to `file_path`, downloading it from MinIO only if it is not cached yet.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        self._read_entry(minio_client, bucket_name, object_name, lambda entry_path: shutil.copyfile(entry_path,
+                                                                                                    file_path))
+
+    def read_object(self, minio_client: Minio, bucket_name: str, object_name: str) -> bytes:
+        """
+        Read an object in memory, downloading it from MinIO only if it is not cached yet.
+        """
+
+        def _read(entry_path):
+            with open(entry_path, "rb") as f:
+                return f.read()
+
+        return self._read_entry(minio_client, bucket_name, object_name, _read)
+
+    def _read_entry(self, minio_client: Minio, bucket_name: str, object_name: str, reader):
+        entry_path = self._get_entry_path(bucket_name, object_name,
+                                          self._get_etag(minio_client, bucket_name, object_name))
+        try:
+            result = reader(entry_path)
+            # The modification time of an entry is its last use, for the caches created later
+            os.utime(entry_path)
+            with self._lock:
+                self.hits += 1
+                if entry_path in self._entries:
+                    self._entries.move_to_end(entry_path)
+                else:
+                    # Written by another process
+                    self._add_entry(entry_path, os.path.getsize(entry_path))
+            return result
+        except FileNotFoundError:
+            with self._lock:
+                # Evicted by another process
+                self._remove_entry(entry_path)
+
+        with self._lock:
+            self.misses += 1
+        result, size = self._download_entry(minio_client, bucket_name, object_name, entry_path, reader)
+        with self._lock:
+            self._remove_entry(entry_path)
+            self._add_entry(entry_path, size)
+            self._scan_bytes += size
+            scan = self._total_bytes > self.max_bytes or self._scan_bytes >= self.max_bytes / 16
+        if scan:
+            self._scan_entries()
+        return result
+
+    def _get_etag(self, minio_client: Minio, bucket_name: str, object_name: str) -> str:
+        now = time.monotonic()
+        with self._lock:
+            etag, asked = self._etags.get((bucket_name, object_name), (None, None))
+        if etag is not None and now - asked < self.etag_ttl:
+            return etag
+        etag = minio_client.stat_object(bucket_name, object_name).etag
+        with self._lock:
+            self._etags[(bucket_name, object_name)] = (etag, now)
+        return etag
+
+    def _get_entry_path(self, bucket_name: str, object_name: str, etag: str) -> str:
+        key = hashlib.sha256(f"{bucket_name}/{object_name}/{etag}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _download_entry(self, minio_client: Minio, bucket_name: str, object_name: str, entry_path: str, reader):
+        """
+        Download an object to the entry and read it with `reader`. The temporary file is read before it becomes the
+        entry, as another process can evict the entry as soon as it exists. Returns the result of `reader` and the size.
+        """
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = f"{entry_path}.{uuid.uuid4().hex}.tmp"
+        response = minio_client.get_object(bucket_name, object_name)
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in response.stream(1024 * 1024):
+                    f.write(chunk)
+                    size += len(chunk)
+            result = reader(tmp_path)
+            os.replace(tmp_path, entry_path)
+        finally:
+            response.close()
+            response.release_conn()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return result, size
+
+    def _scan_entries(self):
+        """
+        Track the entries on disk (from a previous session or other processes) in the order they were last used, and
+        evict the least recently used ones if they are over `max_bytes`.
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                if file_name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        with self._lock:
+            self._entries = OrderedDict()
+            self._total_bytes = 0
+            self._scan_bytes = 0
+            for _, size, path in sorted(entries):
+                self._add_entry(path, size)
+            self._evict()
+
+    def _add_entry(self, entry_path: str, size: int):
+        self._entries[entry_path] = size
+        self._total_bytes += size
+
+    def _remove_entry(self, entry_path: str):
+        self._total_bytes -= self._entries.pop(entry_path, 0)
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the cache fits in `max_bytes`. It is called holding the lock.
+        """
+        while self._total_bytes > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already evicted by another process
+                continue
+            self.evicted_bytes += size
@@ -8,6 +8,7 @@ from urllib3.exceptions import HTTPError
 
 from src.productimeseries.config import settings
 from src.productimeseries.exceptions import RuntimeMinioException
+from src.productimeseries.minio import _get_http_client
 
 
 # Signal used for simulating a time-out in minio connections.
@@ -56,7 +57,9 @@ class MinioConnection(Minio):
             endpoint=f"{host}:{port}",
             access_key=access_key,
             secret_key=secret_key,
-            secure=False
+            secure=False,
+            region=settings.MINIO_REGION,
+            http_client=_get_http_client()
         )
 
     @retry(n_retries=1, delay=10)
@@ -1,20 +1,57 @@
-from pymongo import MongoClient
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Callable
+
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
 from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 from src.productimeseries.config import settings
+from src.productimeseries.instrumentation import span
+
+
+# MongoClients shared by the whole process, one per server and user
+_mongo_clients = {}
+_mongo_clients_lock = Lock()
+_indexes_ensured = False
+_indexes_lock = Lock()
+# The unique index of the time series, and the times the duplicates are merged before giving up creating it
+_TIMESERIES_INDEX = "id_geojson_1_date_-1"
+_TIMESERIES_INDEX_ATTEMPTS = 5
+
+
+def _get_mongo_client(host: str, port: int, username: str, password: str) -> MongoClient:
+    """
+    Get the MongoClient of a server and user, creating it the first time it is needed.
+    MongoClient is thread-safe and keeps its own connection pool, so it is shared instead of creating one per request.
+    """
+    key = (host, port, username, password)
+    with _mongo_clients_lock:
+        mongo_client = _mongo_clients.get(key)
+        if mongo_client is None:
+            mongo_client = MongoClient(
+                host=f"mongodb://{host}:{port}/",
+                username=username,
+                password=password,
+                maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS
+            )
+            _mongo_clients[key] = mongo_client
+    return mongo_client
 
 
 class MongoConnection:
-    """Simple MongoBD class including some useful methods"""
+    """Simple MongoBD class including some useful methods. All the connections share the same MongoClient"""
 
     def __init__(self, host=settings.MONGO_HOST, port=settings.MONGO_PORT, username=settings.MONGO_USERNAME,
                  password=settings.MONGO_PASSWORD, database=settings.MONGO_DB,
                  collection=settings.MONGO_PRODUCTS_COLLECTION):
-        self.mongo_client = MongoClient(
-            host=f"mongodb://{host}:{port}/",
-            username=username,
-            password=password
-        )
+        self.mongo_client = _get_mongo_client(host, port, username, password)
         self.db = database
         self.col = collection
 
@@ -26,3 +63,216 @@ class MongoConnection:
 
     def get_collection_object(self) -> Collection:
         return self.mongo_client[self.db][self.col]
+
+
+class BulkUpserter:
+    """
+    Buffers upserts of a collection and writes them in unordered bulk writes of `batch_size` operations.
+    If `batch_size` is None, operations are only written when `flush` is called. `on_flush` is called after every
+    successful flush, e.g. to write other operations that must never be stored before these ones.
+    """
+
+    def __init__(self, collection: Collection, batch_size: int = settings.MONGO_BULK_SIZE,
+                 on_flush: Callable = None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.operations = []
+        self.upserted_count = 0
+        self.modified_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The buffered operations are written even if the caller failed, they come from finished work
+        self.flush()
+
+    def upsert(self, query: dict, new_values: dict):
+        self.operations.append(UpdateOne(query, new_values, upsert=True))
+        if self.batch_size is not None and len(self.operations) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.operations:
+            operations, self.operations = self.operations, []
+            with span("mongo.bulk_write", collection=self.collection.name) as write_span:
+                write_span.set("operations", len(operations))
+                result = self.collection.bulk_write(operations, ordered=False)
+            self.upserted_count += result.upserted_count
+            self.modified_count += result.modified_count
+            print(f"Bulk write of {len(operations)} operations in {self.collection.name}: "
+                  f"{result.upserted_count} upserted, {result.modified_count} modified")
+        if self.on_flush is not None:
+            self.on_flush()
+
+
+def ensure_indexes():
+    """
+    Create the indexes used by the queries of the workflow if they don't exist yet. It only runs once per process.
+        - products: (date, title), so products are matched by date and tile without reading other documents, and title.
+          The products collection is filled by the download of the products, but its indexes are created here, as
+          they only serve the queries of this service
+        - timeseries: unique (id_geojson, date), see `_ensure_time_series_index`
+        - timeseries state: unique (id_geojson, index)
+        - ingestion ledger: unique (id_geojson, index, product_id) and (id_geojson, index, status)
+        - outliers: unique (id_geojson, index, date)
+        - detectors: unique (id_geojson, index, detector, param_hash)
+    """
+    global _indexes_ensured
+    with _indexes_lock:
+        if _indexes_ensured:
+            return
+        mongo_client = MongoConnection()
+        products_collection = mongo_client.get_collection_object()
+        products_collection.create_index([("date", DESCENDING), ("title", ASCENDING)])
+        products_collection.create_index([("title", ASCENDING)])
+        mongo_client.set_collection(settings.MONGO_TIMESERIES_COLLECTION)
+        timeseries_collection = mongo_client.get_collection_object()
+        mongo_client.set_collection(settings.MONGO_LOCK_COLLECTION)
+        _ensure_time_series_index(timeseries_collection, mongo_client.get_collection_object())
+        mongo_client.set_collection(settings.MONGO_STATE_COLLECTION)
+        state_collection = mongo_client.get_collection_object()
+        state_collection.create_index([("id_geojson", ASCENDING), ("index", ASCENDING)], unique=True)
+        mongo_client.set_collection(settings.MONGO_LEDGER_COLLECTION)
+        ledger_collection = mongo_client.get_collection_object()
+        ledger_collection.create_index([("id_geojson", ASCENDING), ("index", ASCENDING), ("product_id", ASCENDING)],
+                                       unique=True)
+        ledger_collection.create_index([("id_geojson", ASCENDING), ("index", ASCENDING), ("status", ASCENDING)])
+        mongo_client.set_collection(settings.MONGO_OUTLIERS_COLLECTION)
+        outliers_collection = mongo_client.get_collection_object()
+        outliers_collection.create_index([("id_geojson", ASCENDING), ("index", ASCENDING), ("date", DESCENDING)],
+                                         unique=True)
+        mongo_client.set_collection(settings.MONGO_DETECTORS_COLLECTION)
+        detectors_collection = mongo_client.get_collection_object()
+        detectors_collection.create_index([("id_geojson", ASCENDING), ("index", ASCENDING), ("detector", ASCENDING),
+                                           ("param_hash", ASCENDING)], unique=True)
+        _indexes_ensured = True
+
+
+def _ensure_time_series_index(timeseries_collection: Collection, lock_collection: Collection):
+    """
+    Create the unique index (id_geojson, date) of the time series. Time series stored before it existed can have
+    duplicated documents from concurrent upserts, so they are merged first, and again if other sessions or workers
+    upsert new duplicates before the index is created. Only the process holding the lock of the index migrates it, the
+    others wait for it.
+    """
+    owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    while True:
+        timeseries_index = timeseries_collection.index_information().get(_TIMESERIES_INDEX)
+        if timeseries_index is not None and timeseries_index.get("unique"):
+            return
+        if not acquire_lock(lock_collection, _TIMESERIES_INDEX, owner, settings.WORKER_LOCK_TTL):
+            print("The index of the time series is being created by another process")
+            time.sleep(1)
+            continue
+        try:
+            timeseries_index = timeseries_collection.index_information().get(_TIMESERIES_INDEX)
+            if timeseries_index is not None and timeseries_index.get("unique"):
+                return
+            if timeseries_index is not None:
+                timeseries_collection.drop_index(_TIMESERIES_INDEX)
+            for attempt in range(1, _TIMESERIES_INDEX_ATTEMPTS + 1):
+                merge_duplicate_time_series(timeseries_collection)
+                try:
+                    timeseries_collection.create_index([("id_geojson", ASCENDING), ("date", DESCENDING)],
+                                                       unique=True)
+                    return
+                except OperationFailure as err:
+                    # Duplicates upserted while the index didn't exist
+                    if attempt == _TIMESERIES_INDEX_ATTEMPTS:
+                        raise
+                    print(f"Unexpected {err=}, {type(err)=}")
+                    print("New duplicated time series, merging them again")
+        finally:
+            release_lock(lock_collection, _TIMESERIES_INDEX, owner)
+
+
+def merge_duplicate_time_series(collection: Collection) -> int:
+    """
+    Merge the documents of the time series with the same GeoJson and date (e.g. from concurrent upserts) into the
+    oldest of them, the values of the newer ones taking precedence. Returns the number of documents removed.
+    """
+    pipeline = [
+        {"$group": {"_id": {"id_geojson": "$id_geojson", "date": "$date"}, "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    removed = 0
+    for duplicates in collection.aggregate(pipeline, allowDiskUse=True):
+        documents = list(collection.find({"_id": {"$in": duplicates["ids"]}}).sort("_id", ASCENDING))
+        merged = {}
+        for document in documents:
+            _merge_document(merged, document)
+        merged["_id"] = documents[0]["_id"]
+        collection.replace_one({"_id": merged["_id"]}, merged)
+        removed += collection.delete_many({"_id": {"$in": [document["_id"] for document in documents[1:]]}}) \
+            .deleted_count
+    if removed:
+        print(f"Merged {removed} duplicated documents of {collection.name}")
+    return removed
+
+
+def _merge_document(merged: dict, document: dict):
+    for key, value in document.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            _merge_document(merged[key], value)
+        else:
+            merged[key] = value
+
+
+def acquire_lock(collection: Collection, name: str, owner: str, ttl_seconds: int) -> bool:
+    """
+    Take the lock `name` for `owner` during `ttl_seconds`. It can be taken if nobody holds it, if it has expired or if
+    `owner` already holds it (renewing it). Returns whether the lock has been taken.
+    """
+    now = datetime.utcnow()
+    try:
+        # If the lock is held by someone else, the upsert tries to insert a document with the same _id and fails
+        collection.find_one_and_update(
+            {"_id": name, "$or": [{"expires": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "acquired": now, "expires": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def release_lock(collection: Collection, name: str, owner: str):
+    collection.delete_one({"_id": name, "owner": owner})
+
+
+def explain_pipeline(collection: Collection, pipeline: list) -> dict:
+    """
+    Explain an aggregation pipeline and summarize its query plan: the stages and indexes used, whether it uses an index
+    (no collection scan) and whether it is covered by the index (no document fetch).
+    """
+    explanation = collection.database.command(
+        "explain", {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}}, verbosity="queryPlanner"
+    )
+    stages = []
+    indexes = []
+
+    def _walk(node):
+        if isinstance(node, dict):
+            if "rejectedPlans" in node:
+                node = {key: value for key, value in node.items() if key != "rejectedPlans"}
+            if "stage" in node:
+                stages.append(node["stage"])
+            if "indexName" in node:
+                indexes.append(node["indexName"])
+            for value in node.values():
+                _walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                _walk(value)
+
+    _walk(explanation)
+    uses_index = "COLLSCAN" not in stages and "IXSCAN" in stages
+    return {
+        "stages": stages,
+        "indexes": sorted(set(indexes)),
+        "uses_index": uses_index,
+        "covered": uses_index and "FETCH" not in stages,
+    }
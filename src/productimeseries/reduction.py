@@ -0,0 +1,140 @@
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+import rasterio
+
+from src.productimeseries.config import settings
+from src.productimeseries.ingestion_status import IngestionStatus
+from src.productimeseries.instrumentation import span
+from src.productimeseries.utilities.raster import _get_projected_features, _read_labeled_pixels
+from src.productimeseries.utilities.utils import get_tile_from_geojson
+from src.productimeseries.utilities.zonal_statistics import get_zonal_statistics, get_zonal_statistics_by_label
+
+# Pool of processes cropping the products, shared by all the ingestions of the process
+_reduction_pool = None
+_reduction_pool_lock = Lock()
+
+
+def reduce_raster(raster, geojson_paths: dict, statistics: list) -> dict:
+    """
+    Cut a TIF (its content, or the path of a local file) with every GeoJson of `geojson_paths` (a mapping GeoJson name
+    -> GeoJson path) and calculate the zonal statistics of the index (see `get_zonal_statistics`) of the GeoJson, and
+    of each of its features if it has several of them, from a single read.
+    It runs in the threads of the ingestion or in the processes of the reduction pool, so no array is returned, only
+    a small record for each GeoJson: (IngestionStatus value, statistics, reason, pixels read, statistics of the
+    features by feature id or None).
+    """
+    results = {}
+    try:
+        with ExitStack() as stack:
+            if isinstance(raster, bytes):
+                memfile = stack.enter_context(rasterio.io.MemoryFile(raster))
+                band_file = stack.enter_context(memfile.open())
+            else:
+                band_file = stack.enter_context(rasterio.open(raster))
+            for geojson_name, geojson_path in geojson_paths.items():
+                try:
+                    with span("raster.crop") as crop_span:
+                        raster_result, labels, feature_ids = _read_labeled_pixels(band_file, geojson_path)
+                        crop_span.set("pixels", raster_result.size)
+                    with span("zonal_statistics"):
+                        statistics_values = get_zonal_statistics(raster_result, statistics)
+                        feature_statistics = None
+                        if len(feature_ids) > 1:
+                            # As the statistics of the GeoJson, those of the features use the pixels of every band
+                            band_labels = np.tile(labels, raster_result.shape[0])
+                            feature_statistics = {
+                                feature_id: feature_values for feature_id, feature_values in zip(
+                                    feature_ids, get_zonal_statistics_by_label(raster_result, band_labels,
+                                                                               len(feature_ids), statistics))
+                                if feature_values is not None
+                            }
+                    if statistics_values is None:
+                        print("This product only contains nan values for this index")
+                        results[geojson_name] = (IngestionStatus.EMPTY.value, None, "Only nan values",
+                                                 raster_result.size, None)
+                    else:
+                        results[geojson_name] = (IngestionStatus.INGESTED.value, statistics_values, None,
+                                                 raster_result.size, feature_statistics)
+                except Exception as err:
+                    print(f"Unexpected {err=}, {type(err)=}")
+                    print("Something went wrong cutting with " + geojson_name)
+                    results[geojson_name] = (IngestionStatus.FAILED.value, None, f"Cut: {err!r}", 0, None)
+    except Exception as err:
+        print(f"Unexpected {err=}, {type(err)=}")
+        print("Something went wrong opening the TIF")
+        for geojson_name in geojson_paths:
+            results[geojson_name] = (IngestionStatus.FAILED.value, None, f"Cut: {err!r}", 0, None)
+    return results
+
+
+def submit_reduction(raster, geojson_paths: dict, statistics: list) -> Future:
+    """
+    Run `reduce_raster` in the reduction pool, creating the pool the first time it is needed.
+    If a process of the pool has died (e.g. killed for using too much memory) the pool is created again.
+    """
+    global _reduction_pool
+    with _reduction_pool_lock:
+        if _reduction_pool is None:
+            _reduction_pool = _create_reduction_pool()
+        try:
+            return _reduction_pool.submit(reduce_raster, raster, geojson_paths, statistics)
+        except BrokenProcessPool:
+            print("The reduction pool is broken, creating it again")
+            _reduction_pool.shutdown(wait=False)
+            _reduction_pool = _create_reduction_pool()
+            return _reduction_pool.submit(reduce_raster, raster, geojson_paths, statistics)
+
+
+def shutdown_reduction_pool():
+    """
+    Stop the processes of the reduction pool, if it has been created
+    """
+    global _reduction_pool
+    with _reduction_pool_lock:
+        if _reduction_pool is not None:
+            _reduction_pool.shutdown()
+            _reduction_pool = None
+
+
+def _create_reduction_pool() -> ProcessPoolExecutor:
+    """
+    Pool of `settings.INGESTION_PROCESSES` processes. They are spawned, forking a process with running threads
+    (downloads, MongoDB, Streamlit) is not safe. Each process starts with the features of the GeoJsons of
+    `settings.DB_DIR` already projected to the CRS of their tile.
+    """
+    projected_geojsons = []
+    for geojson_path in sorted(Path(settings.DB_DIR).glob('*.geojson')):
+        try:
+            projected_geojsons.append((str(geojson_path), get_tile_crs(get_tile_from_geojson(str(geojson_path)))))
+        except Exception as err:
+            print(f"GeoJson {geojson_path} can't be projected: {err!r}")
+    return ProcessPoolExecutor(max_workers=max(1, settings.INGESTION_PROCESSES),
+                               mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_reduction_process, initargs=(projected_geojsons,))
+
+
+def _init_reduction_process(projected_geojsons: list):
+    """
+    Fill the geometry cache of a new process of the reduction pool, so that tasks only carry the TIF
+    """
+    for geojson_path, crs in projected_geojsons:
+        try:
+            _get_projected_features(geojson_path, os.path.getmtime(geojson_path), crs)
+        except Exception as err:
+            print(f"GeoJson {geojson_path} can't be projected: {err!r}")
+
+
+def get_tile_crs(tile: str) -> str:
+    """
+    CRS of the products of a Sentinel-2 tile (e.g. 30SUF), the UTM zone of the tile in its hemisphere
+    """
+    zone = int(tile[:2])
+    latitude_band = tile[2].upper()
+    return f"EPSG:{32600 + zone if latitude_band >= 'N' else 32700 + zone}"
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import os
+import pickle
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from bson import Binary
+from pymongo.collection import Collection
+
+from src.productimeseries.config import settings
+from src.productimeseries.utilities.outlier_detection import ROLLING_BANDS_DETECTOR, ROLLING_BANDS_VERSION, \
+    StreamingRollingBands, get_window_size, rolling_bands
+
+# Detector classes by name
+DETECTORS = {}
+
+
+def register_detector(detector_class):
+    """
+    Class decorator that makes a detector available in `get_detector` by its name
+    """
+    DETECTORS[detector_class.name] = detector_class
+    return detector_class
+
+
+def get_detector(name: str, **params) -> 'Detector':
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown detector {name}, available detectors: {', '.join(sorted(DETECTORS))}")
+    return DETECTORS[name](**params)
+
+
+class Detector:
+    """
+    Common interface of the outlier detectors of a time series (a pd.Series indexed by date):
+        - fit: learn the model of the detector from a time series.
+        - score: score every point of a time series. Returns a DataFrame with the same index and the columns `score`
+          (the higher the more anomalous) and `anomaly`, and `upper` and `lower` for detectors based on bands.
+        - update: append new points to the fitted time series and return the results of the points that change, only
+          for detectors that support incremental updates (`supports_incremental`).
+    Detectors are identified by their name, version and parameters (`param_hash`), so a fitted detector is only reused
+    with the same parameters. The version must change whenever the results of a detector change.
+    """
+    name = None
+    version = 1
+    supports_incremental = False
+    default_params = {}
+
+    def __init__(self, **params):
+        unknown_params = set(params) - set(self.default_params)
+        if unknown_params:
+            raise ValueError(f"Unknown parameters of detector {self.name}: {', '.join(sorted(unknown_params))}")
+        self.params = {**self.default_params, **params}
+        # Number of points and last date of the fitted time series
+        self.fitted_count = 0
+        self.fitted_last_date = None
+
+    def param_hash(self) -> str:
+        description = json.dumps({"name": self.name, "version": self.version, "params": self.params}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()[:16]
+
+    def fit(self, series: pd.Series) -> 'Detector':
+        series = series.sort_index()
+        self._fit(series)
+        self.fitted_count = len(series)
+        self.fitted_last_date = series.index[-1] if len(series) else None
+        return self
+
+    def score(self, series: pd.Series) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def update(self, new_points: pd.Series) -> pd.DataFrame:
+        raise NotImplementedError(f"Detector {self.name} doesn't support incremental updates, fit it again")
+
+    def can_update(self, count: int) -> bool:
+        """
+        Whether the fitted detector can be updated up to a time series of `count` points instead of fitted again
+        """
+        return self.supports_incremental
+
+    def _fit(self, series: pd.Series):
+        raise NotImplementedError
+
+
+@register_detector
+class RollingBandsDetector(Detector):
+    """
+    Points out of a band of `n_std` standard deviations around the mean of a window centered in each point, with
+    `window_percentage` % of the points of the time series on each side (`rolling_band_outliers`).
+    New points only change the last bands, they are updated with a `StreamingRollingBands`.
+    """
+    name = ROLLING_BANDS_DETECTOR
+    version = ROLLING_BANDS_VERSION
+    supports_incremental = True
+    default_params = {"window_percentage": 5, "n_std": 2.5}
+
+    def __init__(self, **params):
+        super().__init__(**params)
+        self.bands = None
+        # Dates of the values kept by `bands`
+        self.dates = pd.DatetimeIndex([])
+
+    def _fit(self, series: pd.Series):
+        k = get_window_size(len(series), self.params["window_percentage"])
+        self.bands = StreamingRollingBands.from_values(series.to_numpy(dtype=np.float64), k, self.params["n_std"])
+        self.dates = series.index[len(series) - len(self.bands.values):]
+
+    def score(self, series: pd.Series) -> pd.DataFrame:
+        series = series.sort_index()
+        values = series.to_numpy(dtype=np.float64)
+        upper, lower = rolling_bands(values, get_window_size(len(series), self.params["window_percentage"]),
+                                     self.params["n_std"])
+        return self._get_results(series.index, values, upper, lower)
+
+    def update(self, new_points: pd.Series) -> pd.DataFrame:
+        """
+        Append new points, after the fitted ones, with the same window. Once the time series has grown enough for
+        `window_percentage` to give another window, the detector should be fitted again.
+        """
+        changed_bands = {}
+        for date, value in new_points.sort_index().items():
+            positions, upper, lower, _ = self.bands.update(value)
+            self.dates = self.dates.append(pd.DatetimeIndex([date]))[-len(self.bands.values):]
+            # Positions of the changed points in the kept values
+            positions = positions - (self.bands.count - len(self.bands.values))
+            for position, band_upper, band_lower in zip(positions, upper, lower):
+                changed_bands[self.dates[position]] = (self.bands.values[position], band_upper, band_lower)
+        self.fitted_count = self.bands.count
+        if changed_bands:
+            self.fitted_last_date = max(changed_bands)
+        dates = sorted(changed_bands)
+        values, upper, lower = (np.array(column, dtype=np.float64) for column in
+                                zip(*[changed_bands[date] for date in dates])) if dates else (np.empty(0),) * 3
+        return self._get_results(pd.DatetimeIndex(dates), values, upper, lower)
+
+    def can_update(self, count: int) -> bool:
+        return get_window_size(count, self.params["window_percentage"]) == self.bands.k
+
+    def _get_results(self, index: pd.Index, values: np.ndarray, upper: np.ndarray, lower: np.ndarray) -> pd.DataFrame:
+        mean = (upper + lower) / 2
+        std = (upper - lower) / (2 * self.params["n_std"])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Distance to the mean of the window in standard deviations
+            score = np.abs(values - mean) / std
+        anomaly = (values > upper) | (values < lower)
+        return pd.DataFrame({"score": score, "anomaly": anomaly, "upper": upper, "lower": lower}, index=index)
+
+
+@register_detector
+class IQRDetector(Detector):
+    """
+    Points further than `factor` interquartile ranges from the first or the third quartile of the fitted time series
+    (`find_outliers_iqr`).
+    """
+    name = "iqr"
+    default_params = {"factor": 1.5}
+
+    def __init__(self, **params):
+        super().__init__(**params)
+        self.q1 = None
+        self.q3 = None
+
+    def _fit(self, series: pd.Series):
+        self.q1, self.q3 = series.quantile([0.25, 0.75])
+
+    def score(self, series: pd.Series) -> pd.DataFrame:
+        iqr = self.q3 - self.q1
+        upper = self.q3 + self.params["factor"] * iqr
+        lower = self.q1 - self.params["factor"] * iqr
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Distance to the interquartile range in interquartile ranges
+            score = np.maximum(series - self.q3, self.q1 - series).clip(lower=0) / iqr
+        anomaly = (series > upper) | (series < lower)
+        return pd.DataFrame({"score": score, "anomaly": anomaly, "upper": upper, "lower": lower}, index=series.index)
+
+
+@register_detector
+class IsolationForestDetector(Detector):
+    """
+    Isolation forest over the standardized values of the time series. Training it is expensive, so it is trained once
+    per time series and stored with `DiskDetectorStore` or `MongoDetectorStore`; new points are scored with the trained
+    model.
+    """
+    name = "isolation_forest"
+    supports_incremental = True
+    default_params = {"contamination": 0.01, "n_estimators": 200, "random_state": 0}
+
+    def __init__(self, **params):
+        super().__init__(**params)
+        self.scaler = None
+        self.model = None
+
+    def _fit(self, series: pd.Series):
+        # scikit-learn is only imported when this detector is used
+        from sklearn.ensemble import IsolationForest
+        from sklearn.preprocessing import StandardScaler
+
+        self.scaler = StandardScaler()
+        scaled_values = self.scaler.fit_transform(series.to_numpy(dtype=np.float64).reshape(-1, 1))
+        self.model = IsolationForest(contamination=self.params["contamination"],
+                                     n_estimators=self.params["n_estimators"],
+                                     random_state=self.params["random_state"])
+        self.model.fit(scaled_values)
+
+    def score(self, series: pd.Series) -> pd.DataFrame:
+        if len(series) == 0:
+            return pd.DataFrame({"score": np.empty(0), "anomaly": np.empty(0, dtype=bool)}, index=series.index)
+        scaled_values = self.scaler.transform(series.to_numpy(dtype=np.float64).reshape(-1, 1))
+        return pd.DataFrame({"score": -self.model.decision_function(scaled_values),
+                             "anomaly": self.model.predict(scaled_values) == -1}, index=series.index)
+
+    def update(self, new_points: pd.Series) -> pd.DataFrame:
+        new_points = new_points.sort_index()
+        self.fitted_count += len(new_points)
+        if len(new_points):
+            self.fitted_last_date = new_points.index[-1]
+        return self.score(new_points)
+
+
+class DiskDetectorStore:
+    """
+    Fitted detectors of every time series stored as files in `directory`, one per detector and parameters
+    """
+
+    def __init__(self, directory: str = settings.DETECTORS_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, name_geojson: str, index_name: str, detector: Detector):
+        path = self._get_path(name_geojson, index_name, detector.name, detector.param_hash())
+        # Written to a temporary file and renamed, so other processes never load a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(detector, f)
+        os.replace(tmp_path, path)
+
+    def load(self, name_geojson: str, index_name: str, name: str, **params):
+        """
+        Fitted detector of a time series with these parameters, or None if it has not been stored
+        """
+        path = self._get_path(name_geojson, index_name, name, get_detector(name, **params).param_hash())
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def _get_path(self, name_geojson: str, index_name: str, name: str, param_hash: str) -> str:
+        return os.path.join(self.directory, f"{name_geojson}_{index_name}_{name}_{param_hash}.pkl")
+
+
+class MongoDetectorStore:
+    """
+    Fitted detectors of every time series stored in a MongoDB collection, one document per detector and parameters
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    def save(self, name_geojson: str, index_name: str, detector: Detector):
+        query = {"id_geojson": name_geojson, "index": index_name, "detector": detector.name,
+                 "param_hash": detector.param_hash()}
+        self.collection.update_one(query, {"$set": {
+            "version": detector.version,
+            "params": detector.params,
+            "fitted_count": detector.fitted_count,
+            "fitted_last_date": None if detector.fitted_last_date is None else
+            pd.Timestamp(detector.fitted_last_date).to_pydatetime(),
+            "model": Binary(pickle.dumps(detector)),
+            "updated": datetime.utcnow(),
+        }}, upsert=True)
+
+    def load(self, name_geojson: str, index_name: str, name: str, **params):
+        """
+        Fitted detector of a time series with these parameters, or None if it has not been stored
+        """
+        document = self.collection.find_one({"id_geojson": name_geojson, "index": index_name, "detector": name,
+                                             "param_hash": get_detector(name, **params).param_hash()},
+                                            {"_id": 0, "model": 1})
+        return None if document is None else pickle.loads(document["model"])
+
+
+def get_fitted_detector(store, name_geojson: str, index_name: str, series: pd.Series, name: str,
+                        **params) -> Detector:
+    """
+    Detector of a time series ready to score it: the stored one, updated with the points after its fitted ones when it
+    supports incremental updates, or a new one fitted and stored otherwise.
+    """
+    series = series.sort_index()
+    detector = store.load(name_geojson, index_name, name, **params)
+    if detector is not None:
+        new_points = series[series.index > detector.fitted_last_date] if detector.fitted_last_date is not None \
+            else series
+        fitted_points = len(series) - len(new_points)
+        if fitted_points == detector.fitted_count and (len(new_points) == 0 or detector.can_update(len(series))):
+            if len(new_points):
+                detector.update(new_points)
+                store.save(name_geojson, index_name, detector)
+            return detector
+    detector = get_detector(name, **params).fit(series)
+    store.save(name_geojson, index_name, detector)
+    return detector
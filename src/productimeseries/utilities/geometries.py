@@ -1,6 +1,4 @@
 import json
-import warnings
-from functools import partial
 from typing import Callable
 from zipfile import ZipFile
 
@@ -114,9 +112,10 @@ def _get_mgrs_from_geometry(geometry: dict):
     This wont work for geometry bigger than a tile. A chunk of the image could not fit between the products of the 4 corners
     """
     tiles = set()
+    mgrs = MGRS()
     corners = _get_corners_geometry(geometry)
     for point in corners.values():
-        tiles.add(MGRS().toMGRS(*point, MGRSPrecision=0))
+        tiles.add(mgrs.toMGRS(*point, MGRSPrecision=0))
 
     return tiles
 
@@ -127,20 +126,19 @@ def _get_corners_geometry(geometry: dict):
     """
 
     coordinates = geometry["coordinates"]
-    if geometry["type"] == "MultiPolygon":
-        coordinates = coordinates[0]  # TODO multiple polygons in a geometry
     lon = []
     lat = []
     if geometry["type"] == "Point":
         lon.append(coordinates[0])
         lat.append(coordinates[1])
     else:
-        coordinates = coordinates[
-            0
-        ]  # Takes only the outer ring of the polygon: https://geojson.org/geojson-spec.html#polygon
-        for coordinate in coordinates:
-            lon.append(coordinate[0])
-            lat.append(coordinate[1])
+        # The bounding box of a MultiPolygon covers all of its polygons
+        polygons = coordinates if geometry["type"] == "MultiPolygon" else [coordinates]
+        for polygon in polygons:
+            # Takes only the outer ring of the polygon: https://geojson.org/geojson-spec.html#polygon
+            for coordinate in polygon[0]:
+                lon.append(coordinate[0])
+                lat.append(coordinate[1])
 
     max_lon = max(lon)
     min_lon = min(lon)
@@ -208,13 +206,8 @@ def _project_shape(geom: dict, scs: str = "epsg:4326", dcs: str = "epsg:32630"):
     Returns:
         p_geom (dict) : Geometry proyected to destination coordinate system
     """
-    # TODO remove this warning catcher
-    # This disables FutureWarning: '+init=<authority>:<code>' syntax is deprecated. '<authority>:<code>' is the preferred initialization method. When making the change, be mindful of axis order changes: https://pyproj4.github.io/pyproj/stable/gotchas.html#axis-order-changes-in-proj-6 in_crs_string = _prepare_from_proj_string(in_crs_string)
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        project = partial(
-            pyproj.transform, pyproj.Proj(init=scs), pyproj.Proj(init=dcs)
-        )
+    # always_xy keeps the (lon, lat) axis order of the deprecated '+init=<authority>:<code>' projections
+    project = pyproj.Transformer.from_crs(scs, dcs, always_xy=True).transform
 
     return transform(project, shape(geom))
 
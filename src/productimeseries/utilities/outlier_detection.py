@@ -1,9 +1,15 @@
-from src.productimeseries.config import settings
-from src.productimeseries.mongo import MongoConnection
-from datetime import datetime as dt
+import warnings
+from typing import Tuple
+
+import numpy as np
 import pandas as pd
 
 
+# Rolling bands detector whose results are stored in MongoDB, its version must change whenever its results change
+ROLLING_BANDS_DETECTOR = 'rolling_bands'
+ROLLING_BANDS_VERSION = 1
+
+
 def find_outliers_iqr(df: pd.DataFrame):
     q1 = df.quantile(0.25)
     q3 = df.quantile(0.75)
@@ -11,6 +17,219 @@ def find_outliers_iqr(df: pd.DataFrame):
     return df[((df < (q1 - 1.5 * iqr)) | (df > (q3 + 1.5 * iqr)))]
 
 
+def rolling_band_outliers(series: pd.Series, window_percentage: float = 5, n_std: float = 2.5) -> pd.DataFrame:
+    """
+    Detect outliers of a time series as the points out of a band of `n_std` standard deviations around the mean of a
+    window centered in every point. The window has `window_percentage` % of the points of the series on each side.
+    Returns a DataFrame with the same index as the series and the columns `upper`, `lower` and `anomaly`.
+    """
+    k = get_window_size(len(series), window_percentage)
+    upper, lower = rolling_bands(series.to_numpy(dtype=np.float64), k, n_std)
+    anomalies = (series > upper) | (series < lower)
+    return pd.DataFrame({'upper': upper, 'lower': lower, 'anomaly': anomalies}, index=series.index)
+
+
+def get_window_size(n: int, window_percentage: float) -> int:
+    """
+    Number of points on each side of the window of a series of `n` points.
+    """
+    return int(n * (window_percentage / 100))
+
+
+def rolling_bands(values: np.ndarray, k: int, n_std: float = 2.5) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Upper and lower bands of a series, mean +/- `n_std` standard deviations of the window [i - k, i + k) of every point
+    i, truncated at the edges of the series. Nan values are left out of the windows.
+    Windows are computed with cumulative sums, so the cost is O(n) whatever the size of the window.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    valid = ~np.isnan(values)
+    # Values are centered before the cumulative sums to avoid losing precision in the variance
+    shift = values[valid].mean() if valid.any() else 0.0
+    centered = np.where(valid, values - shift, 0.0)
+    cum_count = np.concatenate(([0], np.cumsum(valid)))
+    cum_sum = np.concatenate(([0.0], np.cumsum(centered)))
+    cum_squares = np.concatenate(([0.0], np.cumsum(centered ** 2)))
+
+    positions = np.arange(n)
+    start = np.maximum(positions - k, 0)
+    end = np.minimum(positions + k, n)
+    count = cum_count[end] - cum_count[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (cum_sum[end] - cum_sum[start]) / count
+        variance = (cum_squares[end] - cum_squares[start]) / count - mean ** 2
+    std = np.sqrt(np.maximum(variance, 0.0))
+    mean = mean + shift
+    return mean + n_std * std, mean - n_std * std
+
+
+def detect_outliers_frame(frame: pd.DataFrame, window_percentage: float = 5, n_std: float = 2.5) -> pd.DataFrame:
+    """
+    Detect the outliers of several time series at once. `frame` has a row per date and a column per time series, with
+    nan where a time series has no value, e.g. zones x indexes as read by `get_time_series_frame`.
+    Each time series gets the rolling bands of `rolling_band_outliers`, computed over its own points, and the IQR
+    outliers of `find_outliers_iqr`.
+    Returns a tidy DataFrame with a row per date and time series with a value: the date, the labels of the time series
+    (a column per level of the columns of `frame`), the value, the bands and the `anomaly` and `iqr_outlier` flags.
+    """
+    frame = frame.sort_index()
+    values = frame.to_numpy(dtype=np.float64)
+    upper, lower = rolling_bands_columns(values, window_percentage, n_std)
+    with np.errstate(invalid='ignore'):
+        anomaly = (values > upper) | (values < lower)
+    iqr_outlier = iqr_outliers_columns(values)
+
+    n_dates, n_series = values.shape
+    tidy = {'date': np.repeat(frame.index.to_numpy(), n_series)}
+    level_names = [name if name is not None else ('series' if frame.columns.nlevels == 1 else f'level_{level}')
+                   for level, name in enumerate(frame.columns.names)]
+    for level, name in enumerate(level_names):
+        tidy[name] = np.tile(frame.columns.get_level_values(level).to_numpy(), n_dates)
+    tidy.update({'value': values.ravel(), 'upper': upper.ravel(), 'lower': lower.ravel(),
+                 'anomaly': anomaly.ravel(), 'iqr_outlier': iqr_outlier.ravel()})
+    tidy = pd.DataFrame(tidy)
+    return tidy[~np.isnan(values.ravel())].reset_index(drop=True)
+
+
+def rolling_bands_columns(values: np.ndarray, window_percentage: float = 5,
+                          n_std: float = 2.5) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    `rolling_bands` of every column of a 2-D array (dates x time series) in a single vectorized pass. Nan values are
+    padding: the points of each column are moved to the top keeping their order, so that each time series gets the
+    window of `get_window_size` of its own number of points, and its bands are computed over its own points.
+    The bands of padding values are nan.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = values.shape[0]
+    valid = ~np.isnan(values)
+    # Stable sort, valid values first in the same order
+    order = np.argsort(~valid, axis=0, kind='stable')
+    compact = np.take_along_axis(values, order, axis=0)
+    counts = valid.sum(axis=0)
+    k = (counts * (window_percentage / 100)).astype(int)
+
+    with np.errstate(invalid='ignore'):
+        shift = np.where(counts > 0, np.nansum(values, axis=0) / np.maximum(counts, 1), 0.0)
+    centered = np.where(np.arange(n)[:, None] < counts, compact - shift, 0.0)
+    cum_sum = np.vstack((np.zeros((1, values.shape[1])), np.cumsum(centered, axis=0)))
+    cum_squares = np.vstack((np.zeros((1, values.shape[1])), np.cumsum(centered ** 2, axis=0)))
+
+    positions = np.arange(n)[:, None]
+    start = np.maximum(positions - k, 0)
+    end = np.minimum(positions + k, counts)
+    count = np.maximum(end - start, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (np.take_along_axis(cum_sum, end, axis=0) - np.take_along_axis(cum_sum, start, axis=0)) / count
+        variance = (np.take_along_axis(cum_squares, end, axis=0) -
+                    np.take_along_axis(cum_squares, start, axis=0)) / count - mean ** 2
+    std = np.sqrt(np.maximum(variance, 0.0))
+    mean = np.where(positions < counts, mean + shift, np.nan)
+
+    upper = np.empty_like(values)
+    lower = np.empty_like(values)
+    np.put_along_axis(upper, order, mean + n_std * std, axis=0)
+    np.put_along_axis(lower, order, mean - n_std * std, axis=0)
+    return upper, lower
+
+
+def iqr_outliers_columns(values: np.ndarray) -> np.ndarray:
+    """
+    Outliers of `find_outliers_iqr` of every column of a 2-D array (dates x time series), ignoring nan values.
+    """
+    if len(values) == 0:
+        return np.zeros(values.shape, dtype=bool)
+    with warnings.catch_warnings():
+        # Columns without values have nan quantiles
+        warnings.simplefilter('ignore', RuntimeWarning)
+        q1, q3 = np.nanquantile(values, [0.25, 0.75], axis=0)
+    iqr = q3 - q1
+    with np.errstate(invalid='ignore'):
+        return (values < (q1 - 1.5 * iqr)) | (values > (q3 + 1.5 * iqr))
+
+
+class StreamingRollingBands:
+    """
+    Online version of `rolling_bands` for a window of fixed size k, for time series that grow by appending points.
+    A new point only enters the windows of the last k points (including its own), so appending it updates k bands in
+    O(k): only the last 2k values are kept, with the cumulative sums of their values and squares.
+    The state is a plain dict (`to_dict` / `from_dict`) that can be stored between runs.
+    """
+
+    def __init__(self, k: int, n_std: float = 2.5, shift: float = None):
+        self.k = k
+        self.n_std = n_std
+        # Values are centered around `shift` as in `rolling_bands`, it is the first value if it is not given
+        self.shift = shift
+        # Number of points of the time series, and its last 2k values
+        self.count = 0
+        self.values = np.empty(0, dtype=np.float64)
+
+    @classmethod
+    def from_values(cls, values: np.ndarray, k: int, n_std: float = 2.5) -> 'StreamingRollingBands':
+        """
+        Detector of a time series whose first points are `values`.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        detector = cls(k, n_std, shift=values[valid].mean() if valid.any() else None)
+        detector.count = len(values)
+        detector.values = values[max(0, len(values) - detector._tail_size()):].copy()
+        return detector
+
+    def update(self, value: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Append a point to the time series and return the positions, in the time series, of the points whose bands have
+        changed, with their new upper and lower bands and anomaly flags.
+        """
+        value = float(value)
+        if self.shift is None and not np.isnan(value):
+            self.shift = value
+        self.values = np.append(self.values[max(0, len(self.values) + 1 - self._tail_size()):], value)
+        self.count += 1
+
+        n = self.count
+        offset = n - len(self.values)
+        valid = ~np.isnan(self.values)
+        centered = np.where(valid, self.values - (self.shift or 0.0), 0.0)
+        cum_count = np.concatenate(([0], np.cumsum(valid)))
+        cum_sum = np.concatenate(([0.0], np.cumsum(centered)))
+        cum_squares = np.concatenate(([0.0], np.cumsum(centered ** 2)))
+
+        positions = np.arange(max(0, n - max(self.k, 1)), n)
+        start = np.maximum(positions - self.k, 0) - offset
+        end = np.minimum(positions + self.k, n) - offset
+        count = cum_count[end] - cum_count[start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (cum_sum[end] - cum_sum[start]) / count
+            variance = (cum_squares[end] - cum_squares[start]) / count - mean ** 2
+        std = np.sqrt(np.maximum(variance, 0.0))
+        mean = mean + (self.shift or 0.0)
+        upper, lower = mean + self.n_std * std, mean - self.n_std * std
+        points = self.values[positions - offset]
+        return positions, upper, lower, (points > upper) | (points < lower)
+
+    def _tail_size(self) -> int:
+        # Windows of the last k points start 2k points before the end, the last point is always needed for its flag
+        return max(2 * self.k, 1)
+
+    def to_dict(self) -> dict:
+        return {
+            'k': self.k,
+            'n_std': self.n_std,
+            'shift': self.shift,
+            'count': self.count,
+            # nan values are stored as None
+            'values': [None if np.isnan(value) else float(value) for value in self.values],
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'StreamingRollingBands':
+        detector = cls(state['k'], state['n_std'], state['shift'])
+        detector.count = state['count']
+        detector.values = np.array([np.nan if value is None else value for value in state['values']],
+                                   dtype=np.float64)
+        return detector
 
 
 # if __name__ == '__main__':
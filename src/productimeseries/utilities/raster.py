@@ -1,11 +1,16 @@
 import json
+import os
+from collections import OrderedDict
+from functools import lru_cache
 from itertools import compress
+from threading import Lock
 from pathlib import Path
 from typing import Iterable, List, Tuple
 import numpy as np
 import pyproj
 import rasterio
 from pymongo.collection import Collection
+from rasterio import features as rfeatures
 from rasterio import mask as msk
 from rasterio.warp import Resampling, reproject
 from shapely.geometry import Point, Polygon
@@ -20,6 +25,10 @@ from src.productimeseries.utilities.geometries import (
     _project_shape,
 )
 
+# Label images of the features of the GeoJsons, shared by all the products with the same grid
+_geometry_masks = OrderedDict()
+_geometry_masks_lock = Lock()
+
 
 def _read_raster(
         band_path: str,
@@ -31,6 +40,8 @@ def _read_raster(
 ):
     """
     Reads a raster as a numpy array.
+    When the raster only has to be cropped, just the window covering the geometry is read from the file, so memory and
+    decoding time depend on the size of the geometry and not on the size of the raster.
     Parameters:
         band_path (str) : Path of the raster to be read.
         mask_geometry (dict) : If the raster wants to be cropped, a geometry can be provided.
@@ -48,8 +59,14 @@ def _read_raster(
     with rasterio.open(band_path) as band_file:
         # Read file
         kwargs = band_file.meta
-        destination_crs = band_file.crs
-        band = band_file.read()
+        # If the band is not transformed before being cropped, only the window covering the geometry is read
+        crop_on_read = bool(mask_geometry) and not rescale and normalize_range is None and not (
+                to_tif and kwargs["driver"] == "JP2OpenJPEG")
+        if crop_on_read:
+            print(f"Cropping raster {band_name}")
+            band, kwargs = _mask_band_file(band_file, mask_geometry)
+        else:
+            band = band_file.read()
 
     # Just in case...
     if len(band.shape) == 2:
@@ -77,28 +94,12 @@ def _read_raster(
 
     # Create a temporal memory file to mask the band
     # This is necessary because the band is previously read to scale its resolution
-    if mask_geometry:
+    if mask_geometry and not crop_on_read:
         print(f"Cropping raster {band_name}")
-        projected_geometry = _project_shape(mask_geometry, dcs=destination_crs)
         with rasterio.io.MemoryFile() as memfile:
             with memfile.open(**kwargs) as memfile_band:
                 memfile_band.write(band)
-                projected_geometry = _convert_3D_2D(projected_geometry)
-                masked_band, masked_transform = msk.mask(
-                    memfile_band, shapes=[projected_geometry], crop=True, nodata=np.nan
-                )
-                masked_band = masked_band.astype(np.float32)
-                kwargs = memfile_band.meta.copy()
-                band = masked_band
-
-        kwargs.update(
-            {
-                "driver": "GTiff",
-                "height": band.shape[1],
-                "width": band.shape[2],
-                "transform": masked_transform,
-            }
-        )
+                band, kwargs = _mask_band_file(memfile_band, mask_geometry)
 
     if path_to_disk is not None:
         with rasterio.open(path_to_disk, "w", **kwargs) as dst_file:
@@ -106,6 +107,98 @@ def _read_raster(
     return band
 
 
+def _mask_band_file(band_file, mask_geometry: dict):
+    """
+    Crops an opened raster with a geometry, filling the pixels outside the geometry with nan.
+    Only the window of the raster covering the bounds of the projected geometry is read.
+    Returns the cropped band as a float32 numpy array and its metadata.
+    """
+    projected_geometry = _project_shape(mask_geometry, dcs=band_file.crs)
+    projected_geometry = _convert_3D_2D(projected_geometry)
+    masked_band, masked_transform = msk.mask(
+        band_file, shapes=[projected_geometry], crop=True, nodata=np.nan
+    )
+    masked_band = masked_band.astype(np.float32)
+    kwargs = band_file.meta.copy()
+    kwargs.update(
+        {
+            "driver": "GTiff",
+            "height": masked_band.shape[1],
+            "width": masked_band.shape[2],
+            "transform": masked_transform,
+        }
+    )
+    return masked_band, kwargs
+
+
+def _read_labeled_pixels(band_file, geojson_path: str):
+    """
+    Reads the pixels of an opened raster that fall inside any feature of a GeoJson, with the label of their feature.
+    The features are rasterized once per grid into a label image (see `_get_feature_labels`), so the statistics of all
+    of them can be calculated from a single read.
+    Returns a float32 numpy array of shape (count, pixels inside the features) with nodata values as nan, the label of
+    each pixel (1 for the first feature, 2 for the second...) and the ids of the features.
+    """
+    window, labels, feature_ids = _get_feature_labels(band_file, geojson_path)
+    inside_mask = labels > 0
+    band = band_file.read(window=window, masked=True).astype(np.float32).filled(np.nan)
+    return band[:, inside_mask], labels[inside_mask], feature_ids
+
+
+def _get_feature_labels(band_file, geojson_path: str):
+    """
+    Get the window of an opened raster covering all the features of a GeoJson and the label image of that window:
+    0 outside the features and i + 1 inside the i-th feature. Pixels inside several features are labeled with the last
+    one. Pixels are inside a feature as `msk.mask(..., crop=True)` computes them.
+    Label images are cached per (GeoJson path and modification time, CRS, transform, shape), keeping the last
+    `settings.MASK_CACHE_SIZE` ones.
+    """
+    geojson_mtime = os.path.getmtime(geojson_path)
+    crs = band_file.crs.to_string()
+    key = ("labels", geojson_path, geojson_mtime, crs, tuple(band_file.transform), band_file.shape)
+    with _geometry_masks_lock:
+        if key in _geometry_masks:
+            _geometry_masks.move_to_end(key)
+            return _geometry_masks[key]
+
+    projected_features = _get_projected_features(geojson_path, geojson_mtime, crs)
+    geometries = [geometry for _, geometry in projected_features]
+    window = rfeatures.geometry_window(band_file, geometries)
+    labels = rfeatures.rasterize(
+        [(geometry, label) for label, geometry in enumerate(geometries, start=1)],
+        out_shape=(window.height, window.width), transform=band_file.window_transform(window), fill=0,
+        dtype="int32"
+    )
+    feature_labels = (window, labels, [feature_id for feature_id, _ in projected_features])
+    with _geometry_masks_lock:
+        _geometry_masks[key] = feature_labels
+        while len(_geometry_masks) > settings.MASK_CACHE_SIZE:
+            _geometry_masks.popitem(last=False)
+    return feature_labels
+
+
+@lru_cache(maxsize=settings.MASK_CACHE_SIZE)
+def _get_projected_features(geojson_path: str, geojson_mtime: float, crs: str) -> tuple:
+    """
+    Get the id and the geometry projected to a CRS, as a 2D shapely geometry, of every feature of a GeoJson.
+    The id of a feature is its `id`, or its position in the GeoJson if it has none or it is empty, with the dots and
+    dollars replaced as it is used as a key of MongoDB documents.
+    """
+    with open(geojson_path) as f:
+        features = json.load(f)['features']
+    return tuple(
+        (_get_feature_id(feature, position), _convert_3D_2D(_project_shape(feature['geometry'], dcs=crs)))
+        for position, feature in enumerate(features)
+    )
+
+
+def _get_feature_id(feature: dict, position: int) -> str:
+    feature_id = feature.get('id')
+    if feature_id is None or str(feature_id) == '':
+        feature_id = position
+    return str(feature_id).replace('.', '_').replace('$', '_')
+
+
 def _get_raster_filename_from_path(raster_path):
     """
     Get a filename from a raster's path
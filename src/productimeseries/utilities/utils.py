@@ -1,5 +1,5 @@
 from sentinelsat.sentinel import read_geojson
-from datetime import datetime
+from datetime import datetime, timedelta
 from pymongo.cursor import Cursor
 from src.productimeseries.minio import MinioConnection
 from pathlib import Path
@@ -7,9 +7,20 @@ from src.productimeseries.utilities.geometries import _get_mgrs_from_geometry
 import calendar
 import json
 from src.productimeseries.utilities.raster import _read_raster
+import numpy as np
+import pandas as pd
 from datetime import datetime as dt
 from src.productimeseries.mongo import *
+from src.productimeseries.ingestion_status import IngestionStatus
 import os
+import hashlib
+import tempfile
+from threading import Lock
+
+# Tile index of the GeoJsons: absolute path -> {tile, hash, mtime}
+_tile_index = {}
+_tile_index_loaded = False
+_tile_index_lock = Lock()
 
 
 def _group_polygons_by_tile(*geojson_files: str) -> dict:
@@ -50,59 +61,270 @@ def get_products_by_tile_and_date(
     Query to mongo for obtaining products filtered by tile, date and cloud percentage
     """
     product_metadata_cursor = mongo_collection.aggregate(
-        [
-            {
-                "$project": {
-                    "_id": 1,
-                    "indexes": {
-                        "$filter": {
-                            "input": "$indexes",
-                            "as": "index",
-                            "cond": {
-                                "$and": [
-                                    {"$eq": ["$$index.mask.geojson", "teatinos"]},
-                                    {"$eq": ["$$index.name", "cloud-mask"]},
-                                    {"$lt": ["$$index.value", cloud_percentage]},
-                                ]
-                            },
-                        }
-                    },
-                    "id": 1,
-                    "title": 1,
-                    "size": 1,
-                    "date": 1,
-                    "creationDate": 1,
-                    "ingestionDate": 1,
-                    "objectName": 1,
-                }
-            },
-            {
-                "$match": {
-                    "indexes.0": {"$exists": True},
-                    "title": {"$regex": f"_T{tile}_"},
-                    "date": {
-                        "$gte": start_date,
-                        "$lte": end_date,
-                    },
-                }
-            },
-            {
-                "$sort": {"date": -1}
-            },
-        ]
+        _get_products_by_tile_and_date_pipeline(tile, start_date, end_date, cloud_percentage)
     )
 
     return product_metadata_cursor
 
 
+def _get_products_by_tile_and_date_pipeline(tile: str, start_date: datetime, end_date: datetime,
+                                            cloud_percentage=0.05) -> list:
+    """
+    Pipeline of `get_products_by_tile_and_date`. Products are matched first on the indexed (date, title) fields and
+    only the matching ones are projected.
+    """
+    return [
+        {
+            "$match": {
+                "date": {
+                    "$gte": start_date,
+                    "$lte": end_date,
+                },
+                **_get_products_by_tile_filter(tile, cloud_percentage),
+            }
+        },
+        {
+            "$sort": {"date": -1}
+        },
+        {
+            "$project": {
+                "_id": 1,
+                "indexes": {
+                    "$filter": {
+                        "input": "$indexes",
+                        "as": "index",
+                        "cond": {
+                            "$and": [
+                                {"$eq": ["$$index.mask.geojson", "teatinos"]},
+                                {"$eq": ["$$index.name", "cloud-mask"]},
+                                {"$lt": ["$$index.value", cloud_percentage]},
+                            ]
+                        },
+                    }
+                },
+                "id": 1,
+                "title": 1,
+                "size": 1,
+                "date": 1,
+                "creationDate": 1,
+                "ingestionDate": 1,
+                "objectName": 1,
+            }
+        },
+    ]
+
+
+def _get_products_by_tile_filter(tile: str, cloud_percentage=0.05) -> dict:
+    """
+    Filter of the products of a tile with a cloud percentage lower than `cloud_percentage` in teatinos
+    """
+    return {
+        "title": {"$regex": f"_T{tile}_"},
+        "indexes": {
+            "$elemMatch": {
+                "mask.geojson": "teatinos",
+                "name": "cloud-mask",
+                "value": {"$lt": cloud_percentage},
+            }
+        },
+    }
+
+
+def get_last_product_date(mongo_collection: Collection, tile: str, end_date: str, cloud_percentage=0.05):
+    """
+    Date of the last product of a tile until `end_date`, or None if there are no products.
+    It is a single indexed lookup instead of querying all the products of the range.
+    """
+    query = {
+        "date": {"$lte": datetime.strptime(end_date, '%Y-%m-%d')},
+        **_get_products_by_tile_filter(tile, cloud_percentage),
+    }
+    last_product = mongo_collection.find_one(query, {"_id": 0, "date": 1}, sort=[("date", -1)])
+    return None if last_product is None else last_product["date"]
+
+
+def get_last_time_series_date(mongo_collection: Collection, name_geojson: str, index_name: str, end_date: str):
+    """
+    Date of the last value of a time series until `end_date`, or None if the time series doesn't exist yet.
+    """
+    query = {
+        "id_geojson": name_geojson,
+        index_name: {"$exists": True},
+        "date": {"$lte": datetime.strptime(end_date, '%Y-%m-%d')},
+    }
+    last_ts = mongo_collection.find_one(query, {"_id": 0, "date": 1}, sort=[("date", -1)])
+    return None if last_ts is None else last_ts["date"]
+
+
+def get_time_series_watermark(mongo_collection: Collection, name_geojson: str, index_name: str):
+    """
+    State of the ingestion of a time series: date of the last ingested product and number of ingested products.
+    Returns None if the time series has never been ingested with watermarks.
+    """
+    return mongo_collection.find_one({"id_geojson": name_geojson, "index": index_name}, {"_id": 0})
+
+
+def set_time_series_watermark(mongo_collection: Collection, name_geojson: str, index_name: str,
+                              last_product_date: datetime, products_count: int):
+    """
+    Move the watermark of a time series after ingesting `products_count` products up to `last_product_date`.
+    """
+    mongo_collection.update_one(
+        {"id_geojson": name_geojson, "index": index_name},
+        {
+            "$max": {"last_product_date": last_product_date},
+            "$inc": {"products_count": products_count},
+            "$set": {"updated": datetime.utcnow()},
+        },
+        upsert=True
+    )
+
+
+def get_done_product_ids(mongo_collection: Collection, name_geojsons: list, index_names: list,
+                         product_ids: list) -> dict:
+    """
+    Get, from the ingestion ledger, the products that don't need to be processed again for every (GeoJson, index):
+    products already ingested, products that only contain nan values and products that failed
+    `settings.INGESTION_MAX_ATTEMPTS` times.
+    Returns a mapping (GeoJson name, index) -> set of product ids.
+    """
+    ledger_cursor = mongo_collection.find(
+        {
+            "id_geojson": {"$in": name_geojsons},
+            "index": {"$in": index_names},
+            "product_id": {"$in": product_ids},
+            "$or": [
+                {"status": {"$in": [IngestionStatus.INGESTED.value, IngestionStatus.EMPTY.value]}},
+                {"attempts": {"$gte": settings.INGESTION_MAX_ATTEMPTS}},
+            ],
+        },
+        {"_id": 0, "id_geojson": 1, "index": 1, "product_id": 1}
+    )
+    done_product_ids = {}
+    for entry in ledger_cursor:
+        done_product_ids.setdefault((entry["id_geojson"], entry["index"]), set()).add(entry["product_id"])
+    return done_product_ids
+
+
+def has_ledger_entries(mongo_collection: Collection, name_geojson: str, index_name: str) -> bool:
+    """
+    Whether the ingestion of a time series has been recorded in the ingestion ledger.
+    """
+    return mongo_collection.find_one({"id_geojson": name_geojson, "index": index_name}, {"_id": 1}) is not None
+
+
+def has_pending_failures(mongo_collection: Collection, name_geojson: str, index_name: str) -> bool:
+    """
+    Whether a time series has products that failed and can be tried again.
+    """
+    query = {
+        "id_geojson": name_geojson,
+        "index": index_name,
+        "status": IngestionStatus.FAILED.value,
+        "attempts": {"$lt": settings.INGESTION_MAX_ATTEMPTS},
+    }
+    return mongo_collection.find_one(query, {"_id": 1}) is not None
+
+
+def get_ledger_update(product_id: str, name_geojson: str, index_name: str, status: IngestionStatus,
+                      reason: str = None):
+    """
+    Query and update that record the result of processing a product for a time series in the ingestion ledger.
+    """
+    query = {"product_id": product_id, "id_geojson": name_geojson, "index": index_name}
+    new_values = {
+        "$set": {"status": status.value, "reason": reason, "updated": datetime.utcnow()},
+        "$inc": {"attempts": 1},
+    }
+    return query, new_values
+
+
+def get_time_series_update(name_geojson: str, date: datetime, statistics_by_index: dict,
+                           feature_statistics_by_index: dict = None):
+    """
+    Query and update that store the zonal statistics of the indexes of a product for a GeoJson. The mean of every
+    index is stored as the value of the index, and all the statistics in the sub-document `stats.<index>`.
+    The statistics of each feature of a GeoJson with several features (index -> {feature id: statistics}) are stored
+    in `features.<feature id>.<index>`.
+    """
+    query = {'id_geojson': name_geojson, 'date': date}
+    new_values = {"$set": {}}
+    for index_name, statistics in statistics_by_index.items():
+        new_values["$set"][index_name] = statistics["mean"]
+        new_values["$set"]["stats." + index_name] = statistics
+    for index_name, feature_statistics in (feature_statistics_by_index or {}).items():
+        for feature_id, statistics in feature_statistics.items():
+            new_values["$set"]["features." + feature_id + "." + index_name] = statistics
+    return query, new_values
+
+
 def get_tile_from_geojson(geojson_path: str) -> str:
-    """ From GJSON get TILES """
-    tiles = _group_polygons_by_tile(geojson_path)
-    list_tiles = list(tiles.keys())
-    tile = list_tiles[0]
+    """ From GJSON get TILES
+        Tiles are looked up in a tile index of the GeoJsons of `settings.DB_DIR`, stored in `settings.TILE_INDEX_FILE`.
+        A GeoJson is only parsed again when its modification time and its content hash change.
+    """
+    global _tile_index_loaded
+    with _tile_index_lock:
+        if not _tile_index_loaded:
+            _load_tile_index()
+            _tile_index_loaded = True
+        tile, changed = _get_tile_index_entry(geojson_path)
+        if changed:
+            _save_tile_index()
     return tile
 
 
+def _load_tile_index():
+    """
+    Load the stored tile index and bring it up to date with the GeoJsons of `settings.DB_DIR`.
+    """
+    if os.path.exists(settings.TILE_INDEX_FILE):
+        try:
+            with open(settings.TILE_INDEX_FILE) as f:
+                _tile_index.update(json.load(f))
+        except ValueError:
+            print(f"Tile index {settings.TILE_INDEX_FILE} is corrupted, it will be rebuilt")
+
+    changed = False
+    for geojson_path in sorted(Path(settings.DB_DIR).glob('*.geojson')):
+        _, entry_changed = _get_tile_index_entry(str(geojson_path))
+        changed = changed or entry_changed
+    if changed or not os.path.exists(settings.TILE_INDEX_FILE):
+        _save_tile_index()
+
+
+def _get_tile_index_entry(geojson_path: str):
+    """
+    Get the tile of a GeoJson from the tile index, computing it again if the GeoJson has changed.
+    Returns the tile and whether the tile index has been modified.
+    """
+    key = os.path.abspath(geojson_path)
+    mtime = os.path.getmtime(geojson_path)
+    entry = _tile_index.get(key)
+    if entry is not None and entry['mtime'] == mtime:
+        return entry['tile'], False
+
+    with open(geojson_path, 'rb') as f:
+        geojson_hash = hashlib.sha1(f.read()).hexdigest()
+    if entry is None or entry['hash'] != geojson_hash:
+        tiles = _group_polygons_by_tile(geojson_path)
+        entry = {'tile': list(tiles.keys())[0], 'hash': geojson_hash}
+    entry['mtime'] = mtime
+    _tile_index[key] = entry
+    return entry['tile'], True
+
+
+def _save_tile_index():
+    """
+    Write the tile index atomically, so other processes never read it half written.
+    """
+    tile_index_dir = os.path.dirname(os.path.abspath(settings.TILE_INDEX_FILE))
+    os.makedirs(tile_index_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=tile_index_dir, suffix='.tmp', delete=False) as f:
+        json.dump(_tile_index, f, indent=2)
+    os.replace(f.name, settings.TILE_INDEX_FILE)
+
+
 def get_time_series_from_products_mongo(mongo_collection: Collection, name_geojson: str, index_name: str,
                                         start_date: str, end_date: str):
     """ Get time series index from specific geojson file and a range of dates
@@ -110,25 +332,183 @@ def get_time_series_from_products_mongo(mongo_collection: Collection, name_geojs
     """
 
     timeseries_metadata_cursor = mongo_collection.aggregate(
-        [
-            {
-                "$match": {
-                    'id_geojson': name_geojson,
-                    index_name: {'$exists': True},
-                    "date": {
-                        "$gte": dt.strptime(str(start_date), '%Y-%m-%d'),
-                        "$lte": dt.strptime(str(end_date), '%Y-%m-%d')},
-                }
-            },
-            {
-                "$sort": {"date": -1}
-            },
-        ]
+        _get_time_series_pipeline(name_geojson, index_name, start_date, end_date)
     )
 
     return list(timeseries_metadata_cursor)
 
 
+def get_time_series_dataframe(mongo_collection: Collection, name_geojson: str, index_name: str,
+                              start_date: str = None, end_date: str = None) -> pd.DataFrame:
+    """ Get time series index from specific geojson file and a range of dates (the whole time series by default) as a
+        DataFrame indexed by date.
+        Only the date and the index are read, and they are returned by MongoDB as two arrays in a single document, so
+        the DataFrame is built without going through the documents one by one.
+    """
+    pipeline = _get_time_series_pipeline(name_geojson, index_name, start_date, end_date) + [
+        {
+            "$project": {"_id": 0, "date": 1, index_name: 1}
+        },
+        {
+            "$group": {"_id": None, "dates": {"$push": "$date"}, "values": {"$push": f"${index_name}"}}
+        },
+    ]
+    columns = next(mongo_collection.aggregate(pipeline), {"dates": [], "values": []})
+    dataframe = pd.DataFrame({index_name: np.asarray(columns["values"], dtype=np.float64)},
+                             index=pd.DatetimeIndex(columns["dates"]))
+    return dataframe
+
+
+def get_zonal_statistics_dataframe(mongo_collection: Collection, name_geojson: str, index_name: str,
+                                   start_date: str = None, end_date: str = None) -> pd.DataFrame:
+    """
+    Get the zonal statistics of an index from specific geojson file as a DataFrame indexed by date, in the same order
+    as `get_time_series_dataframe`, with a column per statistic. Products ingested before the statistics were stored
+    only have the mean.
+    """
+    pipeline = _get_time_series_pipeline(name_geojson, index_name, start_date, end_date) + [
+        {
+            "$project": {"_id": 0, "date": 1, index_name: 1, "stats." + index_name: 1}
+        },
+    ]
+    documents = list(mongo_collection.aggregate(pipeline))
+    dataframe = pd.DataFrame([document.get("stats", {}).get(index_name, {"mean": document[index_name]})
+                              for document in documents],
+                             index=pd.DatetimeIndex([document["date"] for document in documents]))
+    return dataframe.astype(np.float64)
+
+
+def get_feature_time_series_dataframe(mongo_collection: Collection, name_geojson: str, index_name: str,
+                                      statistic: str = "mean", start_date: str = None,
+                                      end_date: str = None) -> pd.DataFrame:
+    """
+    Get the time series of a statistic of an index of every feature of a GeoJson with several features as a DataFrame
+    indexed by date, in the same order as `get_time_series_dataframe`, with a column per feature id.
+    """
+    pipeline = _get_time_series_pipeline(name_geojson, index_name, start_date, end_date) + [
+        {
+            "$project": {"_id": 0, "date": 1, "features": 1}
+        },
+    ]
+    documents = list(mongo_collection.aggregate(pipeline))
+    dataframe = pd.DataFrame([{feature_id: indexes[index_name].get(statistic)
+                               for feature_id, indexes in document.get("features", {}).items()
+                               if index_name in indexes}
+                              for document in documents],
+                             index=pd.DatetimeIndex([document["date"] for document in documents]))
+    return dataframe.astype(np.float64)
+
+
+def _get_time_series_pipeline(name_geojson: str, index_name: str, start_date: str = None,
+                              end_date: str = None) -> list:
+    """
+    Pipeline of `get_time_series_from_products_mongo`, it uses the (id_geojson, date) index
+    """
+    match = {
+        'id_geojson': name_geojson,
+        index_name: {'$exists': True},
+    }
+    date_range = _get_date_range(start_date, end_date)
+    if date_range:
+        match["date"] = date_range
+    return [
+        {
+            "$match": match
+        },
+        {
+            "$sort": {"date": -1}
+        },
+    ]
+
+
+def _get_date_range(start_date: str = None, end_date: str = None) -> dict:
+    date_range = {}
+    if start_date is not None:
+        date_range["$gte"] = dt.strptime(str(start_date), '%Y-%m-%d')
+    if end_date is not None:
+        date_range["$lte"] = dt.strptime(str(end_date), '%Y-%m-%d')
+    return date_range
+
+
+def get_time_series_frame(mongo_collection: Collection, name_geojsons: list, index_names: list,
+                          start_date: str = None, end_date: str = None) -> pd.DataFrame:
+    """
+    Get the time series of several GeoJsons and indexes as a single DataFrame with a row per date, in chronological
+    order, and a column per (geojson, index), with nan where a time series has no value for a date.
+    """
+    match = {'id_geojson': {'$in': name_geojsons}}
+    date_range = _get_date_range(start_date, end_date)
+    if date_range:
+        match["date"] = date_range
+    projection = {"_id": 0, "id_geojson": 1, "date": 1, **{index_name: 1 for index_name in index_names}}
+    documents = pd.DataFrame(list(mongo_collection.find(match, projection)),
+                             columns=["date", "id_geojson"] + index_names)
+    frame = documents.set_index(["date", "id_geojson"])[index_names].unstack("id_geojson")
+    frame.columns = frame.columns.swaplevel()
+    columns = pd.MultiIndex.from_product([name_geojsons, index_names], names=["geojson", "index"])
+    frame = frame.reindex(columns=columns).astype(np.float64).sort_index()
+    frame.index = pd.DatetimeIndex(frame.index, name="date")
+    return frame
+
+
+def get_outliers_dataframe(mongo_collection: Collection, name_geojson: str, index_name: str,
+                           start_date: str = None, end_date: str = None) -> pd.DataFrame:
+    """
+    Get the outliers detected in the time series of an index from specific geojson file as a DataFrame indexed by date
+    with the columns `upper`, `lower` and `anomaly`, in the same order as `get_time_series_dataframe`.
+    """
+    match = {'id_geojson': name_geojson, 'index': index_name}
+    date_range = _get_date_range(start_date, end_date)
+    if date_range:
+        match["date"] = date_range
+    pipeline = [
+        {
+            "$match": match
+        },
+        {
+            "$sort": {"date": -1}
+        },
+        {
+            "$group": {"_id": None, "dates": {"$push": "$date"}, "upper": {"$push": "$upper"},
+                       "lower": {"$push": "$lower"}, "anomaly": {"$push": "$anomaly"}}
+        },
+    ]
+    columns = next(mongo_collection.aggregate(pipeline), {"dates": [], "upper": [], "lower": [], "anomaly": []})
+    dataframe = pd.DataFrame({"upper": np.asarray(columns["upper"], dtype=np.float64),
+                              "lower": np.asarray(columns["lower"], dtype=np.float64),
+                              "anomaly": np.asarray(columns["anomaly"], dtype=bool)},
+                             index=pd.DatetimeIndex(columns["dates"]))
+    return dataframe
+
+
+def get_outliers_updates(name_geojson: str, index_name: str, outliers: pd.DataFrame, detector: dict) -> list:
+    """
+    Upserts (query, new values) that store the outliers of a time series, one document per date with the bands, the
+    anomaly flag and the detector (name, version and parameters) that found them.
+    """
+    updates = []
+    for date, upper, lower, anomaly in zip(outliers.index, outliers["upper"], outliers["lower"],
+                                           outliers["anomaly"]):
+        query = {'id_geojson': name_geojson, 'index': index_name, 'date': date.to_pydatetime()}
+        new_values = {"$set": {"upper": float(upper), "lower": float(lower), "anomaly": bool(anomaly),
+                               "detector": detector["name"], "version": detector["version"],
+                               "params": detector["params"]}}
+        updates.append((query, new_values))
+    return updates
+
+
+def set_outliers_state(mongo_collection: Collection, name_geojson: str, index_name: str, outliers_state: dict):
+    """
+    Store, next to the watermark of a time series, the state of its stored outliers: detector, size of the window and
+    number and last date of the points they were computed with.
+    """
+    mongo_collection.update_one(
+        {"id_geojson": name_geojson, "index": index_name},
+        {"$set": {"outliers": outliers_state}},
+        upsert=True
+    )
+
+
 def _download_sample_band_from_product_list(
         sample_band_path: str, title: str, year: str, month: str, index: str, minio_client: MinioConnection
 ):
@@ -136,11 +516,28 @@ def _download_sample_band_from_product_list(
     Having a list of products, download a sample sentinel band of the product.
     """
     minio_bucket_product = settings.MINIO_BUCKET_NAME_PRODUCTS
-    # De esta forma nos traemos los recortes de teatinos
-    sample_band_path_minio = str(Path(year, month, title, 'indexes', 'teatinos', index + '.tif'))
+    sample_band_path_minio = _get_sample_band_object_name(title, year, month, index)
     minio_client.fget_object(minio_bucket_product, sample_band_path_minio, sample_band_path)
 
 
+def _read_sample_band_from_product_list(title: str, year: str, month: str, index: str,
+                                        minio_client: MinioConnection) -> bytes:
+    """
+    Having a list of products, read a sample sentinel band of the product in memory instead of downloading it.
+    """
+    minio_bucket_product = settings.MINIO_BUCKET_NAME_PRODUCTS
+    sample_band_path_minio = _get_sample_band_object_name(title, year, month, index)
+    return minio_client.read_object(minio_bucket_product, sample_band_path_minio)
+
+
+def _get_sample_band_object_name(title: str, year: str, month: str, index: str) -> str:
+    """
+    Get the name of the object in MinIO of an index of a product.
+    """
+    # De esta forma nos traemos los recortes de teatinos
+    return str(Path(year, month, title, 'indexes', 'teatinos', index + '.tif'))
+
+
 def get_products_by_tile_and_specific_date(
         tile: str,
         mongo_collection: Collection,
@@ -150,29 +547,57 @@ def get_products_by_tile_and_specific_date(
     Query to mongo for obtaining products filtered by tile, date and then query MiniO to obtain the required TIF to plot it in the map
     """
     product_cursor = mongo_collection.aggregate(
-        [
-            {
-                "$match": {
-                    "indexes.0": {"$exists": True},
-                    "title": {"$regex": f"_T{tile}_"},
-                    "$expr": {
-                        "$eq": [
-                            specific_date,
-                            {
-                                "$dateToString": {
-                                    "date": "$date",
-                                    "format": "%Y-%m-%d"
-                                }
-                            }
-                        ]
-                    }
-                }
-            }
-        ])
+        _get_products_by_tile_and_specific_date_pipeline(tile, specific_date)
+    )
 
     return product_cursor
 
 
+def _get_products_by_tile_and_specific_date_pipeline(tile: str, specific_date: str) -> list:
+    """
+    Pipeline of `get_products_by_tile_and_specific_date`. The day is matched as a range of dates, so that the date
+    index can be used.
+    """
+    day_start = dt.strptime(specific_date, '%Y-%m-%d')
+    return [
+        {
+            "$match": {
+                "date": {
+                    "$gte": day_start,
+                    "$lt": day_start + timedelta(days=1),
+                },
+                "title": {"$regex": f"_T{tile}_"},
+                "indexes.0": {"$exists": True},
+            }
+        }
+    ]
+
+
+def check_query_indexes(tile: str, name_geojson: str, index_name: str, start_date: str, end_date: str) -> dict:
+    """
+    Explain the queries of the workflow and report, for each of them, whether it uses an index and whether it is
+    covered by the index (documents don't need to be fetched).
+    """
+    mongo_client = MongoConnection()
+    products_collection = mongo_client.get_collection_object()
+    mongo_client.set_collection(settings.MONGO_TIMESERIES_COLLECTION)
+    timeseries_collection = mongo_client.get_collection_object()
+    queries = {
+        'products_by_tile_and_date': (products_collection, _get_products_by_tile_and_date_pipeline(
+            tile, dt.strptime(start_date, '%Y-%m-%d'), dt.strptime(end_date, '%Y-%m-%d'))),
+        'products_by_tile_and_specific_date': (products_collection, _get_products_by_tile_and_specific_date_pipeline(
+            tile, end_date)),
+        'time_series': (timeseries_collection, _get_time_series_pipeline(name_geojson, index_name, start_date,
+                                                                         end_date)),
+    }
+    report = {}
+    for name, (collection, pipeline) in queries.items():
+        report[name] = explain_pipeline(collection, pipeline)
+        print(f"Query {name}: uses index {report[name]['uses_index']} ({', '.join(report[name]['indexes'])}), "
+              f"covered {report[name]['covered']}")
+    return report
+
+
 def _cut_specific_tif(path_geojson: str, sample_band_path: str, sample_band_cut_path: str):
     """
         Cut Raster from specific geometry
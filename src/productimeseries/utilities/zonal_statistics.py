@@ -0,0 +1,118 @@
+import re
+
+import numpy as np
+
+# Statistics of the pixels of a zone that can be ingested, besides the percentiles `p<N>` (e.g. p10, p90)
+ZONAL_STATISTICS = ("mean", "median", "std", "min", "max", "count", "valid_fraction")
+_PERCENTILE_PATTERN = re.compile(r"^p(100|\d{1,2}(\.\d+)?)$")
+
+
+def check_zonal_statistics(statistics) -> list:
+    """
+    Check the names of the statistics to ingest. Returns them as a list, always starting with the mean, that is also
+    stored as the value of the index.
+    """
+    unknown = [statistic for statistic in statistics
+               if statistic not in ZONAL_STATISTICS and not _PERCENTILE_PATTERN.match(statistic)]
+    if unknown:
+        raise ValueError(f"Unknown zonal statistics {unknown}, use {list(ZONAL_STATISTICS)} or p<N> (e.g. p90)")
+    return ["mean"] + [statistic for statistic in dict.fromkeys(statistics) if statistic != "mean"]
+
+
+def get_zonal_statistics(pixels: np.ndarray, statistics: list) -> dict:
+    """
+    Calculate the statistics of the pixels of a zone, where nan is nodata, in a single pass: the valid pixels are
+    selected once and all the percentiles (the median too) come from the same partial sort.
+    `valid_fraction` is the fraction of pixels of the zone that are not nodata.
+    Returns None if the zone only contains nodata.
+    """
+    pixels = np.ravel(pixels)
+    valid_pixels = pixels[~np.isnan(pixels)]
+    if valid_pixels.size == 0:
+        return None
+
+    values = {}
+    percentiles = {}
+    for statistic in statistics:
+        if statistic == "mean":
+            values[statistic] = valid_pixels.mean(dtype=np.float64)
+        elif statistic == "std":
+            values[statistic] = valid_pixels.std(dtype=np.float64)
+        elif statistic == "min":
+            values[statistic] = valid_pixels.min()
+        elif statistic == "max":
+            values[statistic] = valid_pixels.max()
+        elif statistic == "count":
+            values[statistic] = valid_pixels.size
+        elif statistic == "valid_fraction":
+            values[statistic] = valid_pixels.size / pixels.size
+        elif statistic == "median":
+            percentiles[statistic] = 50
+        else:
+            percentiles[statistic] = float(statistic[1:])
+    if percentiles:
+        for statistic, value in zip(percentiles, np.percentile(valid_pixels, list(percentiles.values()))):
+            values[statistic] = value
+    return {statistic: int(values[statistic]) if statistic == "count" else float(values[statistic])
+            for statistic in statistics}
+
+
+def get_zonal_statistics_by_label(pixels: np.ndarray, labels: np.ndarray, n_labels: int, statistics: list) -> list:
+    """
+    Calculate the statistics of the pixels of several zones at once, where `labels` is the zone (1 to `n_labels`) of
+    each pixel and nan is nodata. Counts, sums and squared deviations of all the zones come from `np.bincount`, and the
+    minimums, maximums and percentiles from a single sort of the pixels by zone and value, so the cost doesn't grow with
+    the number of zones.
+    Returns the statistics of each zone as `get_zonal_statistics`, the first one for label 1, with None for the zones
+    that only contain nodata.
+    """
+    pixels = np.ravel(pixels)
+    labels = np.ravel(labels)
+    valid = ~np.isnan(pixels)
+    valid_pixels = pixels[valid].astype(np.float64)
+    valid_labels = labels[valid]
+    counts = np.bincount(valid_labels, minlength=n_labels + 1)
+    if valid_pixels.size == 0:
+        return [None] * n_labels
+
+    values = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if "mean" in statistics or "std" in statistics:
+            means = np.bincount(valid_labels, weights=valid_pixels, minlength=n_labels + 1) / counts
+            values["mean"] = means
+        if "std" in statistics:
+            deviations = (valid_pixels - means[valid_labels]) ** 2
+            values["std"] = np.sqrt(np.bincount(valid_labels, weights=deviations, minlength=n_labels + 1) / counts)
+        if "count" in statistics:
+            values["count"] = counts
+        if "valid_fraction" in statistics:
+            values["valid_fraction"] = counts / np.bincount(labels, minlength=n_labels + 1)
+
+    order_statistics = [statistic for statistic in statistics
+                        if statistic in ("min", "max", "median") or _PERCENTILE_PATTERN.match(statistic)]
+    if order_statistics:
+        # Pixels sorted by zone and then by value, each zone is a slice starting at `starts`
+        sorted_pixels = valid_pixels[np.lexsort((valid_pixels, valid_labels))]
+        starts = np.cumsum(counts) - counts
+        last = np.maximum(counts - 1, 0)
+        for statistic in order_statistics:
+            if statistic == "min":
+                percentile = 0
+            elif statistic == "max":
+                percentile = 100
+            elif statistic == "median":
+                percentile = 50
+            else:
+                percentile = float(statistic[1:])
+            # Linear interpolation between the closest ranks, as `np.percentile`
+            position = last * percentile / 100
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            lower_values = sorted_pixels[np.minimum(starts + lower, sorted_pixels.size - 1)]
+            upper_values = sorted_pixels[np.minimum(starts + upper, sorted_pixels.size - 1)]
+            values[statistic] = lower_values + (upper_values - lower_values) * (position - lower)
+
+    return [None if counts[label] == 0 else
+            {statistic: int(values[statistic][label]) if statistic == "count" else float(values[statistic][label])
+             for statistic in statistics}
+            for label in range(1, n_labels + 1)]
@@ -0,0 +1,39 @@
+import pytest
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    """
+    In-memory mongomock server used by every MongoDB connection of the workflow
+    """
+    mongomock = pytest.importorskip("mongomock")
+    import src.productimeseries.mongo as mongo
+
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(mongo, "_get_mongo_client", lambda *args, **kwargs: client)
+    monkeypatch.setattr(mongo, "_indexes_ensured", False)
+    return client
+
+
+@pytest.fixture
+def local_services(tmp_path, monkeypatch, mongo_client):
+    """
+    Workflow running offline: MinIO served from a local directory (`LocalMinio`), MongoDB from mongomock and the
+    bundled GeoJsons. Returns the root directory of the local MinIO and the mongomock client.
+    """
+    import main
+    from benchmarks.fixtures import GEOJSON_DIR, LocalMinio
+    from src.productimeseries.config import settings
+    from src.productimeseries.reduction import shutdown_reduction_pool
+
+    minio_root = str(tmp_path / "minio")
+    monkeypatch.setattr(LocalMinio, "root", minio_root)
+    monkeypatch.setattr(main, "MinioConnection", LocalMinio)
+    monkeypatch.setattr(settings, "TMP_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "TILE_INDEX_FILE", str(tmp_path / "tile_index.json"))
+    monkeypatch.setattr(settings, "DB_DIR", str(GEOJSON_DIR))
+    monkeypatch.setattr(settings, "MINIO_CACHE_DIR", None)
+    monkeypatch.setattr(settings, "INGESTION_PROCESSES", 2)
+    yield minio_root, mongo_client
+    # The processes of the reduction pool start with the settings of the test
+    shutdown_reduction_pool()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from benchmarks.bench_rolling_bands import _synthetic_series
+from src.productimeseries.utilities.detectors import DETECTORS, DiskDetectorStore, MongoDetectorStore, \
+    get_detector, get_fitted_detector
+from src.productimeseries.utilities.outlier_detection import rolling_band_outliers
+
+
+def test_unknown_detectors_and_parameters_are_rejected():
+    with pytest.raises(ValueError):
+        get_detector("unknown")
+    with pytest.raises(ValueError):
+        get_detector("rolling_bands", window=5)
+
+
+def test_parameters_change_the_hash_of_a_detector():
+    assert get_detector("rolling_bands").param_hash() == get_detector("rolling_bands", n_std=2.5).param_hash()
+    assert get_detector("rolling_bands").param_hash() != get_detector("rolling_bands", n_std=3).param_hash()
+
+
+@pytest.mark.parametrize("name", sorted(DETECTORS))
+def test_detectors_score_every_point(name):
+    if name == "isolation_forest":
+        pytest.importorskip("sklearn")
+    series = _synthetic_series(200)
+
+    result = get_detector(name).fit(series).score(series)
+
+    assert result.index.equals(series.index)
+    assert {"score", "anomaly"} <= set(result.columns)
+    assert result["anomaly"].dtype == bool
+    assert result["anomaly"].any()
+
+
+def test_rolling_bands_detector_matches_rolling_band_outliers():
+    series = _synthetic_series(300)
+
+    result = get_detector("rolling_bands", window_percentage=5, n_std=2.5).score(series)
+    expected = rolling_band_outliers(series, 5, 2.5)
+
+    assert np.allclose(result["upper"], expected["upper"])
+    assert np.allclose(result["lower"], expected["lower"])
+    assert (result["anomaly"] == expected["anomaly"]).all()
+
+
+def test_rolling_bands_detector_updates_the_bands_of_new_points():
+    series = _synthetic_series(315)
+    detector = get_detector("rolling_bands").fit(series[:301])
+    assert detector.can_update(len(series))
+
+    result = detector.update(series[301:])
+    expected = detector.score(series)
+
+    # The new points and the last points before them, whose windows have changed
+    assert result.index.equals(series.index[301 - detector.bands.k + 1:])
+    assert np.allclose(result["upper"], expected.loc[result.index, "upper"])
+    assert np.allclose(result["lower"], expected.loc[result.index, "lower"])
+    assert detector.fitted_count == len(series)
+
+
+@pytest.mark.parametrize("store_name", ["disk", "mongo"])
+def test_fitted_detectors_are_stored_and_updated(store_name, tmp_path, request):
+    if store_name == "disk":
+        store = DiskDetectorStore(str(tmp_path))
+    else:
+        store = MongoDetectorStore(request.getfixturevalue("mongo_client")["test"]["detectors"])
+    series = _synthetic_series(315)
+
+    fitted = get_fitted_detector(store, "Teatinos", "ndvi", series[:301], "rolling_bands")
+    updated = get_fitted_detector(store, "Teatinos", "ndvi", series, "rolling_bands")
+
+    assert fitted.fitted_count == 301
+    assert updated.fitted_count == len(series)
+    assert updated.fitted_last_date == series.index[-1]
+    assert store.load("Teatinos", "ndvi", "rolling_bands").fitted_count == len(series)
+    assert store.load("Teatinos", "ndvi", "rolling_bands", n_std=3) is None
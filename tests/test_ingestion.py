@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+import main
+from benchmarks.fixtures import get_geojson_path, make_products
+from src.productimeseries import ingestion_pipeline
+from src.productimeseries.config import settings
+from src.productimeseries.ingestion_status import IngestionStatus
+
+INDEXES = ["ndvi", "evi"]
+
+
+def _ingest(local_services, products, mode, monkeypatch, tmp_path):
+    minio_root, mongo_client = local_services
+    database = mongo_client[settings.MONGO_DB]
+    timeseries_collection = database["timeseries_" + mode]
+    ledger_collection = database["ledger_" + mode]
+    monkeypatch.setattr(settings, "INGESTION_MODE", mode)
+    counts = main.generate_time_series_batch_from_products({"Teatinos": get_geojson_path("Teatinos")}, INDEXES,
+                                                           products, timeseries_collection, str(tmp_path),
+                                                           ledger_collection)
+    documents = sorted(timeseries_collection.find({}, {"_id": 0}), key=lambda document: document["date"])
+    statuses = {(entry["product_id"], entry["index"]): entry["status"]
+                for entry in ledger_collection.find({}, {"_id": 0})}
+    return counts, documents, statuses
+
+
+@pytest.fixture
+def products(local_services):
+    minio_root, _ = local_services
+    products = make_products(minio_root, settings.MINIO_BUCKET_NAME_PRODUCTS, 6, INDEXES)
+    # A product without the TIF of an index fails to download it
+    for root, _, files in os.walk(minio_root):
+        if products[2]["title"] in root and "evi.tif" in files:
+            os.remove(os.path.join(root, "evi.tif"))
+    return products
+
+
+@pytest.mark.parametrize("mode", ["processes", "async"])
+def test_ingestion_modes_match_threads(local_services, products, mode, monkeypatch, tmp_path):
+    expected_counts, expected_documents, expected_statuses = _ingest(local_services, products, "threads",
+                                                                     monkeypatch, tmp_path)
+
+    counts, documents, statuses = _ingest(local_services, products, mode, monkeypatch, tmp_path)
+
+    assert counts == expected_counts
+    assert counts[("Teatinos", "ndvi")] == len(products)
+    assert counts[("Teatinos", "evi")] == len(products) - 1
+    assert documents == expected_documents
+    assert statuses == expected_statuses
+    assert statuses[(products[2]["id"], "evi")] == IngestionStatus.FAILED.value
+
+
+def test_pipeline_stops_when_a_stage_fails(local_services, products, monkeypatch, tmp_path):
+    def _failing_flush(self):
+        raise RuntimeError("Bulk write failed")
+
+    monkeypatch.setattr(ingestion_pipeline.BulkUpserter, "flush", _failing_flush)
+    # The writer fails with the first product, while the other stages still have products to send it
+    monkeypatch.setattr(settings, "MONGO_BULK_SIZE", 1)
+    monkeypatch.setattr(settings, "PIPELINE_QUEUE_SIZE", 1)
+    start = time.perf_counter()
+
+    with pytest.raises(RuntimeError, match="Bulk write failed"):
+        _ingest(local_services, products, "async", monkeypatch, tmp_path)
+    assert time.perf_counter() - start < 60
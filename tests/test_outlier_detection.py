@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.bench_rolling_bands import _synthetic_series, batch_rolling_bands, legacy_rolling_band_outliers
+from src.productimeseries.utilities.outlier_detection import StreamingRollingBands, detect_outliers_frame, \
+    find_outliers_iqr, get_window_size, rolling_band_outliers, rolling_bands
+from src.productimeseries.utilities.utils import get_time_series_dataframe, get_time_series_frame
+
+
+@pytest.mark.parametrize("n", [10, 100, 500, 2000])
+def test_rolling_band_outliers_match_legacy_bands(n):
+    series = _synthetic_series(n)
+    upper, lower, anomalies = legacy_rolling_band_outliers(series)
+
+    result = rolling_band_outliers(series)
+
+    assert result.index.equals(series.index)
+    assert np.allclose(result["upper"], upper, equal_nan=True)
+    assert np.allclose(result["lower"], lower, equal_nan=True)
+    assert (result["anomaly"] == anomalies).all()
+
+
+def test_rolling_bands_leave_nan_out_of_the_windows():
+    values = _synthetic_series(200).to_numpy(copy=True)
+    values[::7] = np.nan
+    k = 10
+
+    upper, lower = rolling_bands(values, k, n_std=2)
+
+    for i in range(len(values)):
+        window = values[max(0, i - k):min(len(values), i + k)]
+        mean, std = np.nanmean(window), np.nanstd(window)
+        assert upper[i] == pytest.approx(mean + 2 * std)
+        assert lower[i] == pytest.approx(mean - 2 * std)
+
+
+def streaming_rolling_bands(values: np.ndarray, k: int, appended: int, serialize: bool = True):
+    """ Bands of a series whose last `appended` points are appended one by one to a `StreamingRollingBands` """
+    upper, lower = rolling_bands(values[:-appended], k)
+    upper, lower = np.append(upper, np.zeros(appended)), np.append(lower, np.zeros(appended))
+    anomalies = np.zeros(len(values), dtype=bool)
+    anomalies[:-appended] = (values[:-appended] > upper[:-appended]) | (values[:-appended] < lower[:-appended])
+    detector = StreamingRollingBands.from_values(values[:-appended], k)
+    for value in values[-appended:]:
+        if serialize:
+            # The state goes through its serialization as it would between two runs
+            detector = StreamingRollingBands.from_dict(detector.to_dict())
+        positions, upper[positions], lower[positions], anomalies[positions] = detector.update(value)
+    return upper, lower, anomalies
+
+
+@pytest.mark.parametrize("n, appended", [(20, 5), (100, 10), (500, 10), (2000, 30)])
+@pytest.mark.parametrize("serialize", [False, True])
+def test_streaming_bands_match_bands_computed_again(n, appended, serialize):
+    values = _synthetic_series(n).to_numpy()
+    k = get_window_size(n, 5)
+
+    upper, lower, anomalies = batch_rolling_bands(values, k, appended)
+    streaming_upper, streaming_lower, streaming_anomalies = streaming_rolling_bands(values, k, appended, serialize)
+
+    assert np.allclose(streaming_upper, upper, equal_nan=True)
+    assert np.allclose(streaming_lower, lower, equal_nan=True)
+    assert (streaming_anomalies == anomalies).all()
+
+
+def test_streaming_bands_leave_nan_out_of_the_windows():
+    values = _synthetic_series(100).to_numpy(copy=True)
+    values[[3, 95, 98]] = np.nan
+    k = 5
+    detector = StreamingRollingBands.from_values(values[:90], k)
+
+    for end in range(91, len(values) + 1):
+        positions, upper, lower, _ = detector.update(values[end - 1])
+        expected_upper, expected_lower = rolling_bands(values[:end], k)
+        assert np.allclose(upper, expected_upper[positions], equal_nan=True)
+        assert np.allclose(lower, expected_lower[positions], equal_nan=True)
+
+
+def test_batched_outliers_match_each_time_series():
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2018-03-26", periods=300, freq="5D")
+    columns = pd.MultiIndex.from_product([["Teatinos", "Ejido"], ["ndvi", "evi"]], names=["id_geojson", "index"])
+    frame = pd.DataFrame(rng.normal(0.5, 0.1, (len(dates), len(columns))), index=dates, columns=columns)
+    # Time series of different lengths and with different dates
+    frame.iloc[rng.random(frame.shape) < 0.2] = np.nan
+    frame.iloc[:100, 1] = np.nan
+    frame.iloc[:, 3] = np.nan
+    frame = frame.iloc[rng.permutation(len(dates))]
+
+    tidy = detect_outliers_frame(frame, window_percentage=5, n_std=2.5)
+
+    assert len(tidy) == frame.notna().to_numpy().sum()
+    for (geojson, index), column in frame.items():
+        series = column.dropna().sort_index()
+        result = tidy[(tidy["id_geojson"] == geojson) & (tidy["index"] == index)].set_index("date")
+        if series.empty:
+            assert result.empty
+            continue
+        expected = rolling_band_outliers(series, 5, 2.5)
+        assert result.index.equals(series.index)
+        assert np.allclose(result["value"], series)
+        assert np.allclose(result["upper"], expected["upper"], equal_nan=True)
+        assert np.allclose(result["lower"], expected["lower"], equal_nan=True)
+        assert (result["anomaly"] == expected["anomaly"]).all()
+        assert (result["iqr_outlier"] == series.index.isin(find_outliers_iqr(series).dropna().index)).all()
+
+
+def test_time_series_frame_has_the_time_series_of_every_zone_and_index(mongo_client):
+    collection = mongo_client["test"]["timeseries"]
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2020-01-01", periods=40, freq="5D")
+    for geojson in ["Teatinos", "Ejido"]:
+        for date in dates[rng.random(len(dates)) < 0.8]:
+            collection.insert_one({"id_geojson": geojson, "date": date.to_pydatetime(),
+                                   "ndvi": rng.normal(0.5, 0.1), "evi": rng.normal(0.3, 0.1)})
+
+    frame = get_time_series_frame(collection, ["Teatinos", "Ejido", "Unknown"], ["ndvi", "evi"])
+
+    assert frame.index.is_monotonic_increasing
+    assert frame[("Unknown", "ndvi")].isna().all()
+    for geojson in ["Teatinos", "Ejido"]:
+        for index in ["ndvi", "evi"]:
+            expected = get_time_series_dataframe(collection, geojson, index)[index].sort_index()
+            assert np.allclose(frame[(geojson, index)].dropna(), expected)
+            assert frame[(geojson, index)].dropna().index.equals(expected.index)
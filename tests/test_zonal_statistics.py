@@ -0,0 +1,167 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio import mask as msk
+
+from benchmarks.fixtures import get_geojson_path, get_geometry, make_grid_geojson, make_index_tif
+from src.productimeseries.ingestion_status import IngestionStatus
+from src.productimeseries.reduction import reduce_raster
+from src.productimeseries.utilities.geometries import _convert_3D_2D, _project_shape
+from src.productimeseries.utilities.raster import _get_projected_features, _mask_band_file, _read_raster
+from src.productimeseries.utilities.zonal_statistics import check_zonal_statistics, get_zonal_statistics, \
+    get_zonal_statistics_by_label
+
+STATISTICS = ["mean", "median", "std", "min", "max", "count", "valid_fraction", "p10", "p90"]
+
+
+def test_zonal_statistics_names_are_checked():
+    assert check_zonal_statistics(["p90", "median", "mean", "p90"]) == ["mean", "p90", "median"]
+    with pytest.raises(ValueError):
+        check_zonal_statistics(["mean", "p101"])
+    with pytest.raises(ValueError):
+        check_zonal_statistics(["average"])
+
+
+def test_zonal_statistics_match_numpy():
+    rng = np.random.default_rng(0)
+    pixels = rng.uniform(-1, 1, (2, 50, 40)).astype(np.float32)
+    pixels[rng.random(pixels.shape) < 0.1] = np.nan
+    valid_pixels = pixels[~np.isnan(pixels)].astype(np.float64)
+
+    statistics = get_zonal_statistics(pixels, STATISTICS)
+
+    assert statistics["mean"] == pytest.approx(valid_pixels.mean())
+    assert statistics["median"] == pytest.approx(np.median(valid_pixels))
+    assert statistics["std"] == pytest.approx(valid_pixels.std())
+    assert statistics["min"] == pytest.approx(valid_pixels.min())
+    assert statistics["max"] == pytest.approx(valid_pixels.max())
+    assert statistics["count"] == valid_pixels.size
+    assert statistics["valid_fraction"] == pytest.approx(valid_pixels.size / pixels.size)
+    assert statistics["p10"] == pytest.approx(np.percentile(valid_pixels, 10))
+    assert statistics["p90"] == pytest.approx(np.percentile(valid_pixels, 90))
+
+
+def test_zonal_statistics_of_nodata_are_none():
+    assert get_zonal_statistics(np.full((1, 5, 5), np.nan, dtype=np.float32), STATISTICS) is None
+
+
+def test_crop_on_read_matches_cropping_the_whole_raster(tmp_path):
+    tif_path = make_index_tif(str(tmp_path / "index.tif"), seed=0)
+    geometry = get_geometry("Teatinos")
+
+    band = _read_raster(tif_path, mask_geometry=geometry)
+
+    # As the raster was cropped before only the window of the geometry was read: whole raster in memory, then masked
+    with rasterio.open(tif_path) as band_file:
+        kwargs = band_file.meta
+        whole_band = band_file.read()
+    with rasterio.io.MemoryFile() as memfile:
+        with memfile.open(**kwargs) as memfile_band:
+            memfile_band.write(whole_band)
+            expected_band, _ = _mask_band_file(memfile_band, geometry)
+    assert band.shape == expected_band.shape
+    assert np.array_equal(band, expected_band, equal_nan=True)
+
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_reduced_statistics_match_the_cropped_pixels(tmp_path, in_memory):
+    tif_path = make_index_tif(str(tmp_path / "index.tif"), seed=1)
+    with rasterio.open(tif_path) as band_file:
+        projected_geometry = _convert_3D_2D(_project_shape(get_geometry("Teatinos"), dcs=band_file.crs))
+        cropped_band, _ = msk.mask(band_file, shapes=[projected_geometry], crop=True, nodata=np.nan)
+        outside_mask, _, _ = msk.raster_geometry_mask(band_file, [projected_geometry], crop=True)
+    expected = get_zonal_statistics(cropped_band[:, ~outside_mask], STATISTICS)
+    if in_memory:
+        with open(tif_path, "rb") as f:
+            raster = f.read()
+    else:
+        raster = tif_path
+
+    results = reduce_raster(raster, {"Teatinos": get_geojson_path("Teatinos")}, STATISTICS)
+
+    status, statistics, reason, pixels, feature_statistics = results["Teatinos"]
+    assert status == IngestionStatus.INGESTED.value
+    assert reason is None
+    assert pixels == (~outside_mask).sum()
+    assert statistics == pytest.approx(expected)
+    # A GeoJson with a single feature has no statistics by feature
+    assert feature_statistics is None
+
+
+def test_unreadable_rasters_fail_every_geojson():
+    results = reduce_raster(b"not a tif", {"Teatinos": get_geojson_path("Teatinos")}, STATISTICS)
+
+    assert results["Teatinos"][0] == IngestionStatus.FAILED.value
+    assert results["Teatinos"][1] is None
+
+
+def test_statistics_by_label_match_the_statistics_of_each_zone():
+    rng = np.random.default_rng(0)
+    pixels = rng.uniform(-1, 1, 5000).astype(np.float32)
+    pixels[rng.random(pixels.shape) < 0.1] = np.nan
+    labels = rng.integers(1, 5, pixels.size)
+    # Zone 4 only has nodata, zone 5 has no pixels
+    pixels[labels == 4] = np.nan
+
+    statistics_by_label = get_zonal_statistics_by_label(pixels, labels, 5, STATISTICS)
+
+    for label, statistics in enumerate(statistics_by_label, start=1):
+        expected = get_zonal_statistics(pixels[labels == label], STATISTICS)
+        if expected is None:
+            assert statistics is None
+        else:
+            assert statistics == pytest.approx(expected)
+
+
+def _write_two_band_tif(path: str, seed: int) -> str:
+    single_band_path = make_index_tif(path + ".single.tif", seed=seed)
+    with rasterio.open(single_band_path) as band_file:
+        kwargs = band_file.meta
+        band = band_file.read(1)
+    kwargs.update(count=2)
+    with rasterio.open(path, "w", **kwargs) as dst:
+        dst.write(np.stack([band, -band]))
+    return path
+
+
+@pytest.mark.parametrize("count", [1, 2])
+def test_feature_statistics_match_the_pixels_of_each_feature(tmp_path, count):
+    if count == 1:
+        tif_path = make_index_tif(str(tmp_path / "index.tif"), seed=2)
+    else:
+        tif_path = _write_two_band_tif(str(tmp_path / "index.tif"), seed=2)
+    geojson_path = make_grid_geojson(str(tmp_path / "parcels.geojson"), 12)
+    with open(geojson_path) as f:
+        features = json.load(f)["features"]
+
+    results = reduce_raster(tif_path, {"parcels": geojson_path}, STATISTICS)
+
+    status, statistics, _, _, feature_statistics = results["parcels"]
+    assert status == IngestionStatus.INGESTED.value
+    assert sorted(feature_statistics) == sorted(feature["id"] for feature in features)
+    with rasterio.open(tif_path) as band_file:
+        for feature in features:
+            projected_geometry = _convert_3D_2D(_project_shape(feature["geometry"], dcs=band_file.crs))
+            cropped_band, _ = msk.mask(band_file, shapes=[projected_geometry], crop=True, nodata=np.nan)
+            outside_mask, _, _ = msk.raster_geometry_mask(band_file, [projected_geometry], crop=True)
+            expected = get_zonal_statistics(cropped_band[:, ~outside_mask], STATISTICS)
+            assert feature_statistics[feature["id"]] == pytest.approx(expected)
+    # The features of the grid don't overlap, so they split the pixels of the GeoJson
+    assert sum(values["count"] for values in feature_statistics.values()) == statistics["count"]
+
+
+def test_feature_ids_are_valid_mongodb_field_names(tmp_path):
+    geojson_path = make_grid_geojson(str(tmp_path / "parcels.geojson"), 4)
+    with open(geojson_path) as f:
+        geojson = json.load(f)
+    for feature, feature_id in zip(geojson["features"], ["$parcel", "parcel.1", "", None]):
+        feature["id"] = feature_id
+    with open(geojson_path, "w") as f:
+        json.dump(geojson, f)
+
+    projected_features = _get_projected_features(geojson_path, os.path.getmtime(geojson_path), "EPSG:32630")
+
+    assert [feature_id for feature_id, _ in projected_features] == ["_parcel", "parcel_1", "2", "3"]
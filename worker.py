@@ -0,0 +1,81 @@
+"""
+Background ingestion of the time series, decoupled from the Streamlit application.
+Every `--interval` seconds the worker looks for new Sentinel products and updates the time series of every GeoJson of
+`settings.DB_DIR` and every index. Each time series is locked in MongoDB while it is updated, so several workers can
+run at the same time without processing the same time series twice.
+
+    python -m worker
+    python -m worker --once --geojsons Teatinos Bulevar --indexes ndvi evi
+"""
+import argparse
+import os
+import socket
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from main import INDEXES, update_time_series
+from src.productimeseries.config import settings
+from src.productimeseries.instrumentation import start_metrics_server
+from src.productimeseries.mongo import MongoConnection, acquire_lock, release_lock
+
+
+def ingest_time_series(geojson_names: list, indexes: list, start_date: str, end_date: str, owner: str) -> int:
+    """
+    Update the time series of every GeoJson and index whose lock can be taken by `owner`.
+    Returns the number of updated time series.
+    """
+    mongo_client = MongoConnection()
+    mongo_client.set_collection(settings.MONGO_LOCK_COLLECTION)
+    lock_collection = mongo_client.get_collection_object()
+
+    updated = 0
+    for geojson_name in geojson_names:
+        for index in indexes:
+            lock_name = geojson_name + '/' + index
+            if not acquire_lock(lock_collection, lock_name, owner, settings.WORKER_LOCK_TTL):
+                print("Time series " + lock_name + " is being updated by another worker")
+                continue
+            try:
+                with tempfile.TemporaryDirectory() as tmp_dirname:
+                    if update_time_series(geojson_name, start_date, end_date, index, tmp_dirname):
+                        updated += 1
+            except Exception as err:
+                print(f"Unexpected {err=}, {type(err)=}")
+                print("Something went wrong updating " + lock_name)
+            finally:
+                release_lock(lock_collection, lock_name, owner)
+    return updated
+
+
+def _get_geojson_names() -> list:
+    return sorted(path.stem for path in Path(settings.DB_DIR).glob('*.geojson'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--geojsons", nargs="+", help="GeoJsons of `settings.DB_DIR` (all of them by default)")
+    parser.add_argument("--indexes", nargs="+", default=INDEXES)
+    parser.add_argument("--start-date", default=settings.INGESTION_START_DATE)
+    parser.add_argument("--interval", type=int, default=settings.WORKER_INTERVAL,
+                        help="Seconds between two polls for new products")
+    parser.add_argument("--once", action="store_true", help="Update the time series once and exit")
+    args = parser.parse_args()
+
+    start_metrics_server()
+    geojson_names = args.geojsons or _get_geojson_names()
+    owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    while True:
+        end_date = datetime.now().strftime("%Y-%m-%d")
+        print("Worker " + owner + " looking for new products until " + end_date)
+        updated = ingest_time_series(geojson_names, args.indexes, args.start_date, end_date, owner)
+        print("Worker " + owner + " updated " + str(updated) + " time series")
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()